@@ -0,0 +1,107 @@
+import multiprocessing
+import platform
+import queue
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from rules import load_engine
+from search import Searcher
+
+_searcher = None
+_generation = None
+_lines = None
+
+
+def _init_worker(engine_name, generation, lines):
+    global _searcher, _generation, _lines
+    # One searcher per worker, so its transposition table carries over between moves, pondering and move searches.
+    _searcher = Searcher(load_engine(engine_name))
+    _generation = generation
+    _lines = lines
+
+
+def _search_in_worker(position, time_limit, max_depth, generation):
+    result = _searcher.search(position, time_limit, max_depth, should_stop=lambda: _generation.value != generation)
+    return generation, result
+
+
+def _analyse_in_worker(position, lines, max_depth, generation):
+    _searcher.search_lines(position, lines, max_depth=max_depth, on_info=lambda best: _lines.put((generation, best)),
+                           should_stop=lambda: _generation.value != generation)
+    return generation, None
+
+
+class AnalysisExecutor:
+    def __init__(self, engine_name, time_limit=None, max_depth=64):
+        self.engine_name = engine_name
+        self.time_limit = time_limit
+        self.max_depth = max_depth
+        self.generation = multiprocessing.Value('i', 0, lock=False)
+        self.lines = None
+        self.future = None
+        self.pondering = None
+        self.pool = None
+        if platform.system() != "Emscripten":
+            self.lines = multiprocessing.Queue()
+            self.pool = ProcessPoolExecutor(max_workers=1, initializer=_init_worker,
+                                            initargs=(engine_name, self.generation, self.lines))
+        self.searcher = None
+
+    def submit(self, position, time_limit=None):
+        self.cancel()
+        generation = self.generation.value
+        time_limit = time_limit if time_limit is not None else self.time_limit
+        if self.pool is not None:
+            self.future = self.pool.submit(_search_in_worker, position.copy(), time_limit, self.max_depth, generation)
+        else:
+            # No subprocesses in the browser build: search inline and hand back a finished future.
+            if self.searcher is None:
+                self.searcher = Searcher(load_engine(self.engine_name))
+            self.future = Future()
+            self.future.set_result((generation, self.searcher.search(position.copy(), time_limit, self.max_depth)))
+        return self.future
+
+    def poll(self):
+        if self.future is None or not self.future.done():
+            return None
+        future, self.future = self.future, None
+        if future.cancelled():
+            return None
+        generation, result = future.result()
+        if generation != self.generation.value:
+            return None
+        return result
+
+    def ponder(self, position, lines=3):
+        # Runs until cancelled; each finished depth is streamed back through poll_lines.
+        self.cancel()
+        if self.pool is None:
+            return None
+        self.pondering = self.pool.submit(_analyse_in_worker, position.copy(), lines, self.max_depth,
+                                          self.generation.value)
+        return self.pondering
+
+    def poll_lines(self):
+        latest = None
+        while self.lines is not None:
+            try:
+                generation, best = self.lines.get_nowait()
+            except queue.Empty:
+                break
+            if generation == self.generation.value:
+                latest = best
+        return latest
+
+    def busy(self):
+        return self.future is not None
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        self.pondering = None
+        self.generation.value += 1
+
+    def shutdown(self):
+        self.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,299 @@
+import argparse
+import random
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+if not hasattr(np, "bitwise_count"):
+    raise ImportError(f"batch.py needs NumPy 2.0 or later for bitwise_count (found {np.__version__}); "
+                      "run pip install 'numpy>=2.0'")
+
+from bitboard import FULL, FILE_A, FILE_H, ROW_MASKS
+from rules import (PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, WHITE, BLACK, CASTLES, ENGINES, Position, load_engine,
+                   to_fen)
+
+BatchResult = namedtuple("BatchResult", "white_attacks black_attacks in_check legal_moves")
+
+SQUARE_BITS = np.array([1 << sq for sq in range(64)], dtype=np.uint64)
+ZERO = np.uint64(0)
+ONE = np.uint64(1)
+ALL = np.uint64(FULL)
+# Squares that stay on the board after shifting by dx files.
+FILE_GUARDS = {
+    0: ALL,
+    1: np.uint64(FULL ^ FILE_A),
+    2: np.uint64(FULL ^ FILE_A ^ (FILE_A << 1)),
+    -1: np.uint64(FULL ^ FILE_H),
+    -2: np.uint64(FULL ^ FILE_H ^ (FILE_H >> 1)),
+}
+ROOK_STEPS = ((0, -1), (0, 1), (1, 0), (-1, 0))
+BISHOP_STEPS = ((1, -1), (-1, -1), (1, 1), (-1, 1))
+KNIGHT_STEPS = ((2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2))
+KING_STEPS = ROOK_STEPS + BISHOP_STEPS
+# Rows are numbered from Black's side, so White's pawns move towards lower rows.
+FORWARD = {WHITE: -1, BLACK: 1}
+DOUBLE_PUSH_ROW = {WHITE: np.uint64(ROW_MASKS[5]), BLACK: np.uint64(ROW_MASKS[2])}
+PROMOTION_ROW = {WHITE: np.uint64(ROW_MASKS[0]), BLACK: np.uint64(ROW_MASKS[7])}
+
+
+def _mask(squares):
+    return np.uint64(sum(1 << sq for sq in squares))
+
+
+def _castle_masks(color):
+    # (right, king square, rook square, squares that must be empty, squares the king crosses) per castling move.
+    masks = []
+    for right, king_from, king_to, between in CASTLES[color]:
+        rook_from = king_from + 3 if king_to > king_from else king_from - 4
+        masks.append((right, np.uint64(1 << king_from), np.uint64(1 << rook_from), _mask(between),
+                      _mask(((king_from + king_to) >> 1, king_to))))
+    return tuple(masks)
+
+
+CASTLE_MASKS = {WHITE: _castle_masks(WHITE), BLACK: _castle_masks(BLACK)}
+
+
+def _step(bits, dx, dy):
+    shift = dy * 8 + dx
+    moved = bits << np.uint64(shift) if shift > 0 else bits >> np.uint64(-shift)
+    return moved & FILE_GUARDS[dx]
+
+
+def _ray(start, empty, dx, dy):
+    # Squares reached from `start` in one direction, up to and including the first occupied square.
+    attacks = np.zeros_like(start)
+    front = start
+    for _ in range(7):
+        front = _step(front, dx, dy)
+        attacks |= front
+        front = front & empty
+        if not front.any():
+            break
+    return attacks
+
+
+def _sliders(start, empty, steps):
+    attacks = np.zeros_like(start)
+    for dx, dy in steps:
+        attacks |= _ray(start, empty, dx, dy)
+    return attacks
+
+
+def _leaper(bits, steps):
+    attacks = np.zeros_like(bits)
+    for dx, dy in steps:
+        attacks |= _step(bits, dx, dy)
+    return attacks
+
+
+def _pawn_attacks(pawns, color):
+    forward = FORWARD[color]
+    return _step(pawns, 1, forward) | _step(pawns, -1, forward)
+
+
+def _lowest(bits):
+    return bits & (~bits + ONE)
+
+
+def pieces_to_bitboards(pieces):
+    pieces = np.asarray(pieces, dtype=np.uint8)
+    boards = np.zeros((15, len(pieces)), dtype=np.uint64)
+    for color in (WHITE, BLACK):
+        for kind in (PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING):
+            boards[color | kind] = np.where(pieces == color | kind, SQUARE_BITS, ZERO).sum(axis=1, dtype=np.uint64)
+    return boards
+
+
+def positions_to_arrays(positions):
+    pieces = np.frombuffer(b"".join(bytes(p.squares) for p in positions), dtype=np.uint8).reshape(-1, 64)
+    turns = np.array([p.turn == 'b' for p in positions], dtype=bool)
+    castling = np.array([p.castling for p in positions], dtype=np.uint8)
+    ep_squares = np.array([-1 if p.ep_square is None else p.ep_square for p in positions], dtype=np.int8)
+    return pieces, turns, castling, ep_squares
+
+
+def _side(boards, color):
+    return boards[color | PAWN] | boards[color | KNIGHT] | boards[color | BISHOP] | boards[color | ROOK] | \
+        boards[color | QUEEN] | boards[color | KING]
+
+
+def attack_map(boards, color, occupied):
+    empty = ~occupied
+    queens = boards[color | QUEEN]
+    return (_pawn_attacks(boards[color | PAWN], color) | _leaper(boards[color | KNIGHT], KNIGHT_STEPS) |
+            _leaper(boards[color | KING], KING_STEPS) | _sliders(boards[color | ROOK] | queens, empty, ROOK_STEPS) |
+            _sliders(boards[color | BISHOP] | queens, empty, BISHOP_STEPS))
+
+
+def _attackers(target, boards, color, occupied, pawns):
+    # Pieces of `color` attacking the single square in `target`; `pawns` lets a captured pawn be left out.
+    empty = ~occupied
+    queens = boards[color | QUEEN]
+    return ((_leaper(target, KNIGHT_STEPS) & boards[color | KNIGHT]) |
+            (_pawn_attacks(target, color ^ 8) & pawns) |
+            (_leaper(target, KING_STEPS) & boards[color | KING]) |
+            (_sliders(target, empty, ROOK_STEPS) & (boards[color | ROOK] | queens)) |
+            (_sliders(target, empty, BISHOP_STEPS) & (boards[color | BISHOP] | queens)))
+
+
+def _legal_move_counts(boards, color, castling, ep_squares):
+    them = color ^ 8
+    own = _side(boards, color)
+    enemy = _side(boards, them)
+    occupied = own | enemy
+    empty = ~occupied
+    king = boards[color | KING]
+    counts = np.zeros(len(king), dtype=np.int64)
+
+    # Squares the king may not step onto: attacked once the king itself no longer blocks sliders.
+    danger = attack_map(boards, them, occupied ^ king)
+    checkers = (_leaper(king, KNIGHT_STEPS) & boards[them | KNIGHT]) | \
+        (_pawn_attacks(king, color) & boards[them | PAWN])
+    evasions = checkers.copy()
+    pins = []
+    queens = boards[them | QUEEN]
+    for steps, sliders in ((ROOK_STEPS, boards[them | ROOK] | queens), (BISHOP_STEPS, boards[them | BISHOP] | queens)):
+        for dx, dy in steps:
+            ray = _ray(king, empty, dx, dy)
+            first = ray & occupied
+            checking = (first & sliders) != ZERO
+            checkers |= np.where(checking, first, ZERO)
+            evasions |= np.where(checking, ray, ZERO)
+            blocker = first & own
+            beyond = _ray(blocker, empty, dx, dy)
+            pinning = (blocker != ZERO) & ((beyond & sliders) != ZERO)
+            pins.append((np.where(pinning, blocker, ZERO), np.where(pinning, ray | beyond, ZERO)))
+    checks = np.bitwise_count(checkers)
+    target = np.where(checks == 0, ALL, np.where(checks == 1, evasions, ZERO))
+
+    counts += np.bitwise_count(_leaper(king, KING_STEPS) & ~own & ~danger)
+    forward = FORWARD[color]
+    for kind in (PAWN, KNIGHT, BISHOP, ROOK, QUEEN):
+        remaining = boards[color | kind].copy()
+        while remaining.any():
+            piece = _lowest(remaining)
+            remaining ^= piece
+            if kind == PAWN:
+                single = _step(piece, 0, forward) & empty
+                double = _step(single & DOUBLE_PUSH_ROW[color], 0, forward) & empty
+                targets = single | double | (_pawn_attacks(piece, color) & enemy)
+            elif kind == KNIGHT:
+                targets = _leaper(piece, KNIGHT_STEPS)
+            elif kind == BISHOP:
+                targets = _sliders(piece, empty, BISHOP_STEPS)
+            elif kind == ROOK:
+                targets = _sliders(piece, empty, ROOK_STEPS)
+            else:
+                targets = _sliders(piece, empty, ROOK_STEPS + BISHOP_STEPS)
+            targets &= ~own & target
+            for pinned, line in pins:
+                targets = np.where((pinned & piece) != ZERO, targets & line, targets)
+            if kind == PAWN:
+                promotions = targets & PROMOTION_ROW[color]
+                counts += np.bitwise_count(targets ^ promotions) + 4 * np.bitwise_count(promotions).astype(np.int64)
+            else:
+                counts += np.bitwise_count(targets)
+
+    # En passant: replay the capture on the occupancy and look for any attack on the king.
+    has_ep = ep_squares >= 0
+    if has_ep.any():
+        ep_bits = np.where(has_ep, SQUARE_BITS[np.where(has_ep, ep_squares, 0)], ZERO)
+        victims = _step(ep_bits, 0, -forward)
+        capturers = _pawn_attacks(ep_bits, them) & boards[color | PAWN]
+        while capturers.any():
+            piece = _lowest(capturers)
+            capturers ^= piece
+            after = occupied ^ piece ^ ep_bits ^ victims
+            safe = _attackers(king, boards, them, after, boards[them | PAWN] & ~victims) == ZERO
+            counts += (piece != ZERO) & safe
+
+    no_check = checks == 0
+    for right, king_from, rook_from, between, path in CASTLE_MASKS[color]:
+        counts += (((castling & right) != 0) & no_check & ((king & king_from) != ZERO) &
+                   ((boards[color | ROOK] & rook_from) != ZERO) & ((occupied & between) == ZERO) &
+                   ((danger & path) == ZERO))
+    return counts, checks > 0
+
+
+def analyse(pieces, turns, castling=None, ep_squares=None):
+    # Attack maps, check status and legal-move counts for N positions given as an N x 64 array of piece codes.
+    boards = pieces_to_bitboards(pieces)
+    count = boards.shape[1]
+    turns = np.asarray(turns, dtype=bool)
+    castling = np.zeros(count, dtype=np.uint8) if castling is None else np.asarray(castling, dtype=np.uint8)
+    ep_squares = np.full(count, -1, dtype=np.int8) if ep_squares is None else np.asarray(ep_squares, dtype=np.int8)
+    occupied = _side(boards, WHITE) | _side(boards, BLACK)
+    legal_moves = np.zeros(count, dtype=np.int64)
+    in_check = np.zeros(count, dtype=bool)
+    for color, selected in ((WHITE, ~turns), (BLACK, turns)):
+        index = np.nonzero(selected)[0]
+        if len(index):
+            legal_moves[index], in_check[index] = _legal_move_counts(boards[:, index], color, castling[index],
+                                                                     ep_squares[index])
+    return BatchResult(attack_map(boards, WHITE, occupied), attack_map(boards, BLACK, occupied), in_check,
+                       legal_moves)
+
+
+def random_positions(engine, count, rng, max_plies=120):
+    positions = []
+    while len(positions) < count:
+        position = Position()
+        for _ in range(rng.randrange(max_plies)):
+            moves = engine.get_all_legal_moves(position, position.turn)
+            if not moves:
+                break
+            position.make_move(rng.choice(moves))
+        position.stack = []
+        positions.append(position)
+    return positions
+
+
+def reference(engine, positions):
+    from bitboard import is_square_attacked
+    rows = []
+    for position in positions:
+        attacks = [sum(1 << sq for sq in range(64) if is_square_attacked(position, sq, color))
+                   for color in (WHITE, BLACK)]
+        rows.append((attacks[0], attacks[1], engine.is_in_check(position, position.turn),
+                     len(engine.get_all_legal_moves(position, position.turn))))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vectorized attack maps and legal-move counts for many positions.")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="bitboard")
+    parser.add_argument("--positions", type=int, default=20000)
+    parser.add_argument("--check", type=int, default=1000, help="cross-check this many positions against the engine")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    engine = load_engine(args.engine)
+    positions = random_positions(engine, args.positions, random.Random(args.seed))
+    arrays = positions_to_arrays(positions)
+    started = time.perf_counter()
+    result = analyse(*arrays)
+    elapsed = time.perf_counter() - started
+    print(f"batch: {len(positions)} positions in {elapsed:.3f}s, {len(positions) / elapsed:.0f} positions/s")
+
+    sample = positions[:args.check]
+    started = time.perf_counter()
+    rows = reference(engine, sample)
+    elapsed = time.perf_counter() - started
+    print(f"{args.engine}: {len(sample)} positions in {elapsed:.3f}s, {len(sample) / elapsed:.0f} positions/s")
+    mismatches = 0
+    for i, (white_attacks, black_attacks, in_check, legal_moves) in enumerate(rows):
+        got = (int(result.white_attacks[i]), int(result.black_attacks[i]), bool(result.in_check[i]),
+               int(result.legal_moves[i]))
+        if got != (white_attacks, black_attacks, in_check, legal_moves):
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"MISMATCH {to_fen(positions[i])}: batch {got}, "
+                      f"reference {(white_attacks, black_attacks, in_check, legal_moves)}")
+    print(f"{len(rows) - mismatches}/{len(rows)} positions agree with the reference")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,339 @@
+from rules import (PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, WHITE, BLACK, COLORS, OPPONENT, CASTLES, PROMOTIONS,
+                   KNIGHT_TARGETS, KING_TARGETS)
+
+FULL = (1 << 64) - 1
+FILE_A = sum(1 << (row * 8) for row in range(8))
+FILE_H = FILE_A << 7
+ROW_MASKS = [0xFF << (row * 8) for row in range(8)]
+
+# (dx, dy) and whether the ray runs towards higher square indices
+DIRECTIONS = [((0, 1), True), ((1, 0), True), ((1, 1), True), ((-1, 1), True),
+              ((0, -1), False), ((-1, 0), False), ((-1, -1), False), ((1, -1), False)]
+
+
+def _mask(squares):
+    bits = 0
+    for sq in squares:
+        bits |= 1 << sq
+    return bits
+
+
+def _ray_masks(dx, dy):
+    masks = []
+    for sq in range(64):
+        bits = 0
+        x, y = sq % 8 + dx, sq // 8 + dy
+        while 0 <= x < 8 and 0 <= y < 8:
+            bits |= 1 << (y * 8 + x)
+            x += dx
+            y += dy
+        masks.append(bits)
+    return tuple(masks)
+
+
+KNIGHT_ATTACKS = tuple(_mask(targets) for targets in KNIGHT_TARGETS)
+KING_ATTACKS = tuple(_mask(targets) for targets in KING_TARGETS)
+RAY_MASKS = tuple(_ray_masks(dx, dy) for (dx, dy), _ in DIRECTIONS)
+POSITIVE = tuple(positive for _, positive in DIRECTIONS)
+CASTLE_MASKS = {color: tuple((right, king_from, king_to, _mask(between))
+                             for right, king_from, king_to, between in castles)
+                for color, castles in CASTLES.items()}
+PAWN_ATTACKS = {
+    WHITE: tuple(_mask(t for t, ok in ((sq - 9, sq % 8 > 0), (sq - 7, sq % 8 < 7)) if ok and t >= 0)
+                 for sq in range(64)),
+    BLACK: tuple(_mask(t for t, ok in ((sq + 7, sq % 8 > 0), (sq + 9, sq % 8 < 7)) if ok and t < 64)
+                 for sq in range(64)),
+}
+
+
+def _ray_attacks(sq, occupied, directions):
+    attacks = 0
+    for d in directions:
+        ray = RAY_MASKS[d][sq]
+        blockers = ray & occupied
+        if blockers:
+            if POSITIVE[d]:
+                first = (blockers & -blockers).bit_length() - 1
+            else:
+                first = blockers.bit_length() - 1
+            ray ^= RAY_MASKS[d][first]
+        attacks |= ray
+    return attacks
+
+
+def _line_table(sq, directions):
+    # Attacks along one line through sq for every occupancy of the squares that can block it (the far ends can't).
+    mask = 0
+    for d in directions:
+        ray = RAY_MASKS[d][sq]
+        if ray:
+            last = ray.bit_length() - 1 if POSITIVE[d] else (ray & -ray).bit_length() - 1
+            mask |= ray ^ (1 << last)
+    table = {}
+    occupied = 0
+    while True:
+        table[occupied] = _ray_attacks(sq, occupied, directions)
+        occupied = (occupied - mask) & mask
+        if not occupied:
+            return mask, table
+
+
+def _line_tables(lines):
+    return tuple(sum((_line_table(sq, line) for line in lines), ()) for sq in range(64))
+
+
+def _between(start, end):
+    for d in range(8):
+        if RAY_MASKS[d][start] >> end & 1:
+            return RAY_MASKS[d][start] & ~RAY_MASKS[d][end] & ~(1 << end)
+    return 0
+
+
+# Per square: (mask, {occupancy & mask: attacks}) for each line, so a slider costs one lookup per line.
+ROOK_LINES = _line_tables(((0, 4), (1, 5)))
+BISHOP_LINES = _line_tables(((2, 6), (3, 7)))
+# Squares strictly between two squares on a common line, 0 when they are not aligned.
+BETWEEN = tuple(tuple(_between(start, end) for end in range(64)) for start in range(64))
+
+
+def rook_attacks(sq, occupied):
+    file_mask, file_attacks, rank_mask, rank_attacks = ROOK_LINES[sq]
+    return file_attacks[occupied & file_mask] | rank_attacks[occupied & rank_mask]
+
+
+def bishop_attacks(sq, occupied):
+    mask, attacks, anti_mask, anti_attacks = BISHOP_LINES[sq]
+    return attacks[occupied & mask] | anti_attacks[occupied & anti_mask]
+
+
+# Decoded move tuples keyed by target bitboard and start square (or pawn shift): scanning bits costs more than lookups.
+MOVE_LIST_CACHE_SIZE = 1 << 15
+move_lists = {}
+
+
+def _decode_moves(key, start, targets):
+    moves = []
+    while targets:
+        low = targets & -targets
+        moves.append(start | ((low.bit_length() - 1) << 6))
+        targets ^= low
+    if len(move_lists) >= MOVE_LIST_CACHE_SIZE:
+        move_lists.clear()
+    moves = move_lists[key] = tuple(moves)
+    return moves
+
+
+def _decode_pawn_moves(key, targets, shift, last_row):
+    moves = []
+    while targets:
+        low = targets & -targets
+        end = low.bit_length() - 1
+        if low & last_row:
+            moves.extend((end + shift) | (end << 6) | (kind << 12) for kind in PROMOTIONS)
+        else:
+            moves.append((end + shift) | (end << 6))
+        targets ^= low
+    if len(move_lists) >= MOVE_LIST_CACHE_SIZE:
+        move_lists.clear()
+    moves = move_lists[key] = tuple(moves)
+    return moves
+
+
+def _add_moves(moves, start, targets):
+    if targets:
+        key = targets << 7 | start
+        moves.extend(move_lists.get(key) or _decode_moves(key, start, targets))
+
+
+def _add_pawn_moves(moves, pawns, color, empty, enemy, allowed):
+    if color == WHITE:
+        single = (pawns >> 8) & empty
+        double = ((single & ROW_MASKS[5]) >> 8) & empty
+        left = ((pawns & ~FILE_A) >> 9) & enemy
+        right = ((pawns & ~FILE_H) >> 7) & enemy
+        sets = ((single, 8), (double, 16), (left, 9), (right, 7))
+        last_row = ROW_MASKS[0]
+    else:
+        single = (pawns << 8) & empty
+        double = ((single & ROW_MASKS[2]) << 8) & empty
+        left = ((pawns & ~FILE_A) << 7) & enemy
+        right = ((pawns & ~FILE_H) << 9) & enemy
+        sets = ((single, -8), (double, -16), (left, -7), (right, -9))
+        last_row = ROW_MASKS[7]
+    for targets, shift in sets:
+        targets &= allowed
+        if targets:
+            key = targets << 7 | 64 | (shift + 16)
+            moves.extend(move_lists.get(key) or _decode_pawn_moves(key, targets, shift, last_row))
+
+
+def _add_piece_moves(moves, position, color, allowed, pins):
+    # Pawn, knight and slider moves whose target is in allowed; a pinned piece is further held to its pin ray.
+    bitboards = position.bitboards
+    own = position.occupancy[color]
+    enemy = position.occupancy[color ^ 8]
+    occupied = own | enemy
+
+    pawns = bitboards[color | PAWN]
+    if pins:
+        for sq, ray in pins.items():
+            if (1 << sq) & pawns:
+                pawns ^= 1 << sq
+                _add_pawn_moves(moves, 1 << sq, color, ~occupied & FULL, enemy, allowed & ray)
+    if pawns:
+        _add_pawn_moves(moves, pawns, color, ~occupied & FULL, enemy, allowed)
+
+    cached = move_lists.get
+    for kind in (KNIGHT, BISHOP, ROOK, QUEEN):
+        pieces = bitboards[color | kind]
+        while pieces:
+            low = pieces & -pieces
+            sq = low.bit_length() - 1
+            pieces ^= low
+            targets = allowed & pins[sq] if pins and sq in pins else allowed
+            if kind == KNIGHT:
+                targets &= KNIGHT_ATTACKS[sq]
+            elif kind == BISHOP:
+                mask, attacks, anti_mask, anti_attacks = BISHOP_LINES[sq]
+                targets &= attacks[occupied & mask] | anti_attacks[occupied & anti_mask]
+            elif kind == ROOK:
+                file_mask, file_attacks, rank_mask, rank_attacks = ROOK_LINES[sq]
+                targets &= file_attacks[occupied & file_mask] | rank_attacks[occupied & rank_mask]
+            else:
+                targets &= rook_attacks(sq, occupied) | bishop_attacks(sq, occupied)
+            if targets:
+                key = targets << 7 | sq
+                moves.extend(cached(key) or _decode_moves(key, sq, targets))
+
+
+def _add_en_passant(moves, position, color):
+    ep_square = position.ep_square
+    if ep_square is not None:
+        attackers = PAWN_ATTACKS[color ^ 8][ep_square] & position.bitboards[color | PAWN]
+        while attackers:
+            low = attackers & -attackers
+            moves.append((low.bit_length() - 1) | (ep_square << 6))
+            attackers ^= low
+
+
+def get_pseudo_legal_moves(position, player):
+    color = COLORS[player]
+    own = position.occupancy[color]
+    allowed = ~own & FULL
+    moves = []
+    _add_piece_moves(moves, position, color, allowed, {})
+    kings = position.bitboards[color | KING]
+    if kings:
+        sq = kings.bit_length() - 1
+        _add_moves(moves, sq, KING_ATTACKS[sq] & allowed)
+    _add_en_passant(moves, position, color)
+    if position.castling:
+        occupied = own | position.occupancy[color ^ 8]
+        for right, king_from, king_to, between in CASTLE_MASKS[color]:
+            if position.castling & right and not occupied & between:
+                moves.append(king_from | (king_to << 6))
+    return moves
+
+
+def is_square_attacked(position, sq, by_color, occupied=None):
+    bitboards = position.bitboards
+    if occupied is None:
+        occupied = position.occupancy[WHITE] | position.occupancy[BLACK]
+    if KNIGHT_ATTACKS[sq] & bitboards[by_color | KNIGHT]:
+        return True
+    if PAWN_ATTACKS[by_color ^ 8][sq] & bitboards[by_color | PAWN]:
+        return True
+    if KING_ATTACKS[sq] & bitboards[by_color | KING]:
+        return True
+    queens = bitboards[by_color | QUEEN]
+    rooks = bitboards[by_color | ROOK] | queens
+    if rooks and rook_attacks(sq, occupied) & rooks:
+        return True
+    bishops = bitboards[by_color | BISHOP] | queens
+    return bool(bishops and bishop_attacks(sq, occupied) & bishops)
+
+
+def find_king_position(position, player):
+    return position.kings[COLORS[player]]
+
+
+def is_in_check(position, player):
+    king_sq = find_king_position(position, player)
+    if king_sq is None:
+        return False
+    return is_square_attacked(position, king_sq, COLORS[OPPONENT[player]])
+
+
+def get_pins_and_checks(position, king_sq, color):
+    # Sliders seen from the king give check; sliders seen once the king's own blockers are lifted pin those blockers.
+    bitboards = position.bitboards
+    own = position.occupancy[color]
+    enemy = color ^ 8
+    occupied = own | position.occupancy[enemy]
+    queens = bitboards[enemy | QUEEN]
+    checkers = (KNIGHT_ATTACKS[king_sq] & bitboards[enemy | KNIGHT]) | \
+               (PAWN_ATTACKS[color][king_sq] & bitboards[enemy | PAWN])
+    evasions = checkers
+    pins = {}
+    between = BETWEEN[king_sq]
+    for attacks, sliders in ((rook_attacks, bitboards[enemy | ROOK] | queens),
+                             (bishop_attacks, bitboards[enemy | BISHOP] | queens)):
+        if not sliders:
+            continue
+        seen = attacks(king_sq, occupied)
+        hits = seen & sliders
+        checkers |= hits
+        while hits:
+            low = hits & -hits
+            evasions |= between[low.bit_length() - 1] | low
+            hits ^= low
+        pinners = attacks(king_sq, occupied ^ (seen & own)) & sliders & ~seen
+        while pinners:
+            low = pinners & -pinners
+            ray = between[low.bit_length() - 1]
+            pins[(ray & own).bit_length() - 1] = ray | low
+            pinners ^= low
+    return pins, checkers, evasions
+
+
+def get_all_legal_moves(position, player):
+    # Check and pin masks are applied to the target bitboards, so only legal moves are ever materialised.
+    color = COLORS[player]
+    enemy = color ^ 8
+    king_sq = position.kings[color]
+    if king_sq is None:
+        return get_pseudo_legal_moves(position, player)
+    pins, checkers, evasions = get_pins_and_checks(position, king_sq, color)
+    own = position.occupancy[color]
+    occupied = own | position.occupancy[enemy]
+    allowed = ~own & FULL
+    if checkers:
+        allowed = 0 if checkers & (checkers - 1) else allowed & evasions
+    moves = []
+    if allowed:
+        _add_piece_moves(moves, position, color, allowed, pins)
+    ep_square = position.ep_square
+    if ep_square is not None:
+        # The captured pawn leaves a square other than the target, so check the result directly.
+        candidates = []
+        _add_en_passant(candidates, position, color)
+        for move in candidates:
+            position.make_move(move)
+            if not is_square_attacked(position, king_sq, enemy):
+                moves.append(move)
+            position.unmake_move()
+    without_king = occupied ^ (1 << king_sq)
+    targets = KING_ATTACKS[king_sq] & ~own
+    while targets:
+        low = targets & -targets
+        end = low.bit_length() - 1
+        targets ^= low
+        if not is_square_attacked(position, end, enemy, without_king):
+            moves.append(king_sq | (end << 6))
+    if position.castling and not checkers:
+        for right, king_from, king_to, between in CASTLE_MASKS[color]:
+            if position.castling & right and not occupied & between and \
+                    not is_square_attacked(position, (king_from + king_to) >> 1, enemy) and \
+                    not is_square_attacked(position, king_to, enemy, without_king):
+                moves.append(king_from | (king_to << 6))
+    return moves
@@ -0,0 +1,110 @@
+import argparse
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+
+from perft import move_name
+from position_index import MOVE_RECORD, PositionIndex, bisect_records, build_index
+from rules import ENGINES, Position, from_fen, load_engine
+
+MAGIC = b"CBK2"
+HEADER = struct.Struct("<4sI")
+RECORD = struct.Struct("<QHH")
+
+
+def write_book(index, path, min_count=1):
+    entries = 0
+    with open(path + ".tmp", "wb") as out:
+        out.write(HEADER.pack(MAGIC, 0))
+        for i in range(index.move_count):
+            key, move, count = MOVE_RECORD.unpack_from(index.map, index.moves_base + i * MOVE_RECORD.size)
+            if count >= min_count:
+                out.write(RECORD.pack(key, move, min(count, 0xFFFF)))
+                entries += 1
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, entries))
+    os.replace(path + ".tmp", path)
+    return entries
+
+
+def _write_from_index(index_path, path, min_count):
+    index = PositionIndex(index_path)
+    try:
+        return write_book(index, path, min_count)
+    finally:
+        index.close()
+
+
+def build_book(source, path, engine, max_plies=20, min_count=1):
+    if not source.endswith(".pgn"):
+        return _write_from_index(source, path, min_count)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as directory:
+        index_path = os.path.join(directory, "book.idx")
+        build_index(source, index_path, engine, max_plies)
+        return _write_from_index(index_path, path, min_count)
+
+
+class OpeningBook:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an opening book")
+
+    def moves(self, key):
+        index = bisect_records(self.map, HEADER.size, self.count, RECORD.size, key)
+        found = []
+        while index < self.count:
+            record_key, move, weight = RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size)
+            if record_key != key:
+                break
+            found.append((move, weight))
+            index += 1
+        return found
+
+    def legal_moves(self, position, legal_moves):
+        return [(move, weight) for move, weight in self.moves(position.hash) if move in legal_moves]
+
+    def choose(self, position, legal_moves, rng=random):
+        candidates = self.legal_moves(position, legal_moves)
+        if not candidates:
+            return None
+        moves, weights = zip(*candidates)
+        return rng.choices(moves, weights)[0]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query a memory-mapped opening book.")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="bitboard")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build a book from a PGN file or a position index")
+    build.add_argument("source")
+    build.add_argument("book")
+    build.add_argument("--plies", type=int, default=20)
+    build.add_argument("--min-count", type=int, default=2)
+    probe = commands.add_parser("probe")
+    probe.add_argument("book")
+    probe.add_argument("--fen", default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        entries = build_book(args.source, args.book, load_engine(args.engine), args.plies, args.min_count)
+        print(f"wrote {entries} book entries to {args.book}")
+        return 0
+    book = OpeningBook(args.book)
+    position = from_fen(args.fen) if args.fen else Position()
+    for move, weight in sorted(book.moves(position.hash), key=lambda item: -item[1]):
+        print(f"{move_name(move)} {weight}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+from bitboard import FILE_A, KNIGHT_ATTACKS, rook_attacks, bishop_attacks
+from rules import PAWN, KNIGHT, BISHOP, ROOK, QUEEN, WHITE, BLACK, unpack_score
+
+MAX_PHASE = 24
+PHASE_WEIGHTS = ((KNIGHT, 1), (BISHOP, 1), (ROOK, 2), (QUEEN, 4))
+MOBILITY_WEIGHTS = {KNIGHT: 4, BISHOP: 4, ROOK: 2, QUEEN: 1}
+DOUBLED_PAWN = -15
+ISOLATED_PAWN = -12
+# Bonus for a passed pawn by how many rows it has advanced from its starting row.
+PASSED_PAWN = (0, 5, 10, 20, 35, 60, 100, 0)
+PAWN_SHIELD = 10
+OPEN_KING_FILE = -25
+
+FILE_MASKS = tuple(FILE_A << col for col in range(8))
+ADJACENT_FILES = tuple((FILE_MASKS[col - 1] if col > 0 else 0) | (FILE_MASKS[col + 1] if col < 7 else 0)
+                       for col in range(8))
+
+
+def _rows_mask(rows):
+    bits = 0
+    for row in rows:
+        bits |= 0xFF << (row * 8)
+    return bits
+
+
+def _front_masks(color):
+    masks = []
+    for sq in range(64):
+        col, row = sq % 8, sq // 8
+        rows = range(row) if color == WHITE else range(row + 1, 8)
+        masks.append(_rows_mask(rows) & (FILE_MASKS[col] | ADJACENT_FILES[col]))
+    return tuple(masks)
+
+
+def _shield_masks(color):
+    masks = []
+    for sq in range(64):
+        col, row = sq % 8, sq // 8
+        rows = (row - 1, row - 2) if color == WHITE else (row + 1, row + 2)
+        masks.append(_rows_mask(r for r in rows if 0 <= r < 8) & (FILE_MASKS[col] | ADJACENT_FILES[col]))
+    return tuple(masks)
+
+
+PASSED_MASKS = {WHITE: _front_masks(WHITE), BLACK: _front_masks(BLACK)}
+SHIELD_MASKS = {WHITE: _shield_masks(WHITE), BLACK: _shield_masks(BLACK)}
+
+
+def _squares(bits):
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def pawn_structure(white_pawns, black_pawns):
+    score = 0
+    for color, own, enemy, sign in ((WHITE, white_pawns, black_pawns, 1), (BLACK, black_pawns, white_pawns, -1)):
+        side = 0
+        for col in range(8):
+            count = (own & FILE_MASKS[col]).bit_count()
+            if count > 1:
+                side += DOUBLED_PAWN * (count - 1)
+            if count and not own & ADJACENT_FILES[col]:
+                side += ISOLATED_PAWN * count
+        for sq in _squares(own):
+            if not enemy & PASSED_MASKS[color][sq]:
+                side += PASSED_PAWN[6 - sq // 8 if color == WHITE else sq // 8 - 1]
+        score += sign * side
+    return score
+
+
+class PawnTable:
+    def __init__(self, size=1 << 14):
+        self.size = size
+        self.slots = [None] * size
+        self.hits = 0
+        self.misses = 0
+
+    def probe(self, white_pawns, black_pawns):
+        index = (white_pawns * 0x9E3779B97F4A7C15 ^ black_pawns) % self.size
+        entry = self.slots[index]
+        if entry is not None and entry[0] == white_pawns and entry[1] == black_pawns:
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        score = pawn_structure(white_pawns, black_pawns)
+        self.slots[index] = (white_pawns, black_pawns, score)
+        return score
+
+    def clear(self):
+        self.slots = [None] * self.size
+
+
+def mobility(position):
+    bitboards = position.bitboards
+    occupied = position.occupancy[WHITE] | position.occupancy[BLACK]
+    score = 0
+    for color, sign in ((WHITE, 1), (BLACK, -1)):
+        free = ~position.occupancy[color]
+        side = 0
+        for sq in _squares(bitboards[color | KNIGHT]):
+            side += MOBILITY_WEIGHTS[KNIGHT] * (KNIGHT_ATTACKS[sq] & free).bit_count()
+        for sq in _squares(bitboards[color | BISHOP]):
+            side += MOBILITY_WEIGHTS[BISHOP] * (bishop_attacks(sq, occupied) & free).bit_count()
+        for sq in _squares(bitboards[color | ROOK]):
+            side += MOBILITY_WEIGHTS[ROOK] * (rook_attacks(sq, occupied) & free).bit_count()
+        for sq in _squares(bitboards[color | QUEEN]):
+            side += MOBILITY_WEIGHTS[QUEEN] * ((rook_attacks(sq, occupied) | bishop_attacks(sq, occupied))
+                                               & free).bit_count()
+        score += sign * side
+    return score
+
+
+def king_safety(position):
+    bitboards = position.bitboards
+    score = 0
+    for color, sign in ((WHITE, 1), (BLACK, -1)):
+        king = position.kings[color]
+        if king is None:
+            continue
+        pawns = bitboards[color | PAWN]
+        side = PAWN_SHIELD * (pawns & SHIELD_MASKS[color][king]).bit_count()
+        if not pawns & FILE_MASKS[king % 8]:
+            side += OPEN_KING_FILE
+        score += sign * side
+    return score
+
+
+def game_phase(position):
+    bitboards = position.bitboards
+    phase = 0
+    for kind, weight in PHASE_WEIGHTS:
+        phase += weight * (bitboards[WHITE | kind].bit_count() + bitboards[BLACK | kind].bit_count())
+    return min(phase, MAX_PHASE)
+
+
+class Evaluator:
+    def __init__(self, pawn_table_size=1 << 14):
+        self.pawns = PawnTable(pawn_table_size)
+
+    def score(self, position):
+        # White's point of view; material and piece-square terms come from the incrementally kept position score.
+        phase = game_phase(position)
+        opening, endgame = unpack_score(position.score)
+        opening += king_safety(position)
+        score = (opening * phase + endgame * (MAX_PHASE - phase)) // MAX_PHASE
+        score += self.pawns.probe(position.bitboards[WHITE | PAWN], position.bitboards[BLACK | PAWN])
+        return score + mobility(position)
+
+    def evaluate(self, position):
+        score = self.score(position)
+        return score if position.turn == 'w' else -score
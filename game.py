@@ -0,0 +1,81 @@
+from collections import namedtuple
+
+from rules import Position, LegalMoveCache
+
+MoveRecord = namedtuple("MoveRecord", "move white_time black_time")
+
+
+class MoveLog:
+    def __init__(self):
+        self.records = []
+        self.ply = 0
+
+    def push(self, position, move, white_time=None, black_time=None):
+        del self.records[self.ply:]
+        self.records.append(MoveRecord(move, white_time, black_time))
+        position.make_move(move)
+        self.ply += 1
+
+    def can_undo(self):
+        return self.ply > 0
+
+    def can_redo(self):
+        return self.ply < len(self.records)
+
+    def undo(self, position):
+        if not self.can_undo():
+            return None
+        self.ply -= 1
+        position.unmake_move()
+        return self.records[self.ply]
+
+    def redo(self, position):
+        if not self.can_redo():
+            return None
+        record = self.records[self.ply]
+        position.make_move(record.move)
+        self.ply += 1
+        return record
+
+    def jump_to(self, position, ply):
+        ply = max(0, min(ply, len(self.records)))
+        while self.ply > ply:
+            self.undo(position)
+        while self.ply < ply:
+            self.redo(position)
+
+    def moves(self):
+        return [record.move for record in self.records[:self.ply]]
+
+
+def get_outcome(position, legal_moves, in_check):
+    if not legal_moves:
+        if in_check:
+            return ("0-1" if position.turn == 'w' else "1-0"), "checkmate"
+        return "1/2-1/2", "stalemate"
+    if position.halfmove_clock >= 100:
+        return "1/2-1/2", "fifty-move rule"
+    if position.repetitions() >= 3:
+        return "1/2-1/2", "threefold repetition"
+    return None
+
+
+class Game:
+    def __init__(self, engine, position=None, cache_size=4096):
+        self.engine = engine
+        self.position = position or Position()
+        self.log = MoveLog()
+        self.cache = LegalMoveCache(engine, cache_size)
+
+    def legal_moves(self):
+        return self.cache.legal_moves(self.position)
+
+    def in_check(self):
+        return self.cache.in_check(self.position)
+
+    def play(self, move, white_time=None, black_time=None):
+        self.log.push(self.position, move, white_time, black_time)
+
+    def outcome(self):
+        legal_moves, in_check = self.cache.lookup(self.position)
+        return get_outcome(self.position, legal_moves, in_check)
@@ -1,16 +1,35 @@
 import pygame
+import os
 import sys
-import copy
 import asyncio
 import platform
-
-pygame.init()
+import math
+import time
+
+from rules import (INITIAL_BOARD, EMPTY, KNIGHT, BISHOP, ROOK, QUEEN, Position, LegalMoveCache, piece_at,
+                   move_to_coords, load_engine, from_fen)
+from search import MATE, allocate_time
+from analysis import AnalysisExecutor
+from game import MoveLog, get_outcome
+from pgn import PgnError, export_pgn, read_games, replay, move_to_san
+from position_index import PositionIndex
+from book import OpeningBook
+from tablebase import Tablebase
+from evaluation import Evaluator
+from profiler import Profiler
+from server import RESULTS, REASONS, Join, PlayMove, Resign, Started, Moved, Rejected, Ended, connect
+
+STARTED = time.perf_counter()
 
 WIDTH, HEIGHT = 800, 1200
+UI_HEIGHT = HEIGHT - WIDTH
+MIN_BOARD_SIZE = 320
 SQUARE_SIZE = WIDTH // 8
+PROMOTION_SIZE = 100
 WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
 FPS = 60
+ANALYSIS_LINES = 3
 
 THEMES = [
     [(255, 255, 0), (0, 128, 0)],
@@ -18,91 +37,306 @@ THEMES = [
     [(200, 200, 255), (100, 100, 150)],
 ]
 
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Chess")
-font = pygame.font.Font(None, 36)
-clock = pygame.time.Clock()
-
-INITIAL_BOARD = [
-    ["bR", "bN", "bB", "bQ", "bK", "bB", "bN", "bR"],
-    ["bP", "bP", "bP", "bP", "bP", "bP", "bP", "bP"],
-    ["--", "--", "--", "--", "--", "--", "--", "--"],
-    ["--", "--", "--", "--", "--", "--", "--", "--"],
-    ["--", "--", "--", "--", "--", "--", "--", "--"],
-    ["--", "--", "--", "--", "--", "--", "--", "--"],
-    ["wP", "wP", "wP", "wP", "wP", "wP", "wP", "wP"],
-    ["wR", "wN", "wB", "wQ", "wK", "wB", "wN", "wR"]
-]
-
-
-def load_images():
-    pieces = ['bB', 'bK', 'bN', 'bP', 'bQ', 'bR', 'wB', 'wK', 'wN', 'wP', 'wQ', 'wR']
-    images = {}
-    for piece in pieces:
-        images[piece] = pygame.transform.scale(pygame.image.load(f'assets/{piece}.png'), (SQUARE_SIZE, SQUARE_SIZE))
-    return images
-
-
-def draw_board(screen, theme):
-    colors = THEMES[theme]
-    for row in range(8):
-        for col in range(8):
-            color = colors[(row + col) % 2]
-            pygame.draw.rect(screen, color, (col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))
-
-
-def draw_pieces(screen, board, images):
-    for row in range(8):
-        for col in range(8):
-            piece = board[row][col]
-            if piece != '--':
-                screen.blit(images[piece], (col * SQUARE_SIZE, row * SQUARE_SIZE))
-
-
-def draw_highlights(screen, moves):
-    for move in moves:
-        x, y = move[1]
-        pygame.draw.circle(screen, (255, 0, 0),
-                           (x * SQUARE_SIZE + SQUARE_SIZE // 2, y * SQUARE_SIZE + SQUARE_SIZE // 2), 10)
+screen = None
+font = None
+analysis_font = None
+clock = None
+
+
+def get_option(name, default=None):
+    for arg in sys.argv[1:]:
+        if arg.startswith(f"--{name}="):
+            return arg.split("=", 1)[1]
+    return os.environ.get(f"CHESS_{name.upper()}", default)
+
+
+ENGINE = get_option("engine", "bitboard")
+PGN_FILE = get_option("pgn")
+SAVE_FILE = get_option("save", "game.pgn")
+INDEX_FILE = get_option("index")
+BOOK_FILE = get_option("book", "book.bin")
+TABLEBASE_DIR = get_option("tablebases", "tablebases")
+PROFILE_FILE = get_option("profile")
+TRACE_FILE = get_option("trace")
+SERVER = get_option("server")
+engine = load_engine(ENGINE)
+position_index = PositionIndex(INDEX_FILE) if INDEX_FILE else None
+opening_book = OpeningBook(BOOK_FILE) if BOOK_FILE and os.path.exists(BOOK_FILE) else None
+tablebase = Tablebase(TABLEBASE_DIR)
+database_lines = {}
+tablebase_lines = {}
+move_cache = LegalMoveCache(engine)
+evaluator = Evaluator()
+analysis = None
+client = None
+server_task = None
+player_color = None
+show_analysis = False
+analysis_key = None
+analysis_lines = []
+profiler = Profiler()
+show_profiler = False
+COMPUTER = 'b'
+BOARD_RECT = pygame.Rect(0, 0, WIDTH, WIDTH)
+UI_RECT = pygame.Rect(0, WIDTH, WIDTH, UI_HEIGHT)
+EVAL_BAR_RECT = pygame.Rect(50, 300, 620, 20)
+PROFILER_RECT = pygame.Rect(0, 0, 320, 260)
+
+board_backgrounds = {}
+piece_sources = {}
+piece_images = {}
+text_cache = {}
+square_keys = [None] * 64
+ui_key = None
+profiler_font = None
+first_frame_time = None
+
+
+def init_display(size=(WIDTH, HEIGHT)):
+    global font, analysis_font, clock
+    pygame.init()
+    pygame.display.set_caption("Chess")
+    font = pygame.font.Font(None, 36)
+    analysis_font = pygame.font.Font(None, 24)
+    clock = pygame.time.Clock()
+    resize_window(*size)
+
+
+def resize_window(width, height):
+    global screen, SQUARE_SIZE, BOARD_RECT, UI_RECT
+    size = (max(width, WIDTH), max(height, MIN_BOARD_SIZE + UI_HEIGHT))
+    screen = pygame.display.get_surface()
+    if screen is None or screen.get_size() != size:
+        screen = pygame.display.set_mode(size, pygame.RESIZABLE)
+    SQUARE_SIZE = min(size[0], size[1] - UI_HEIGHT) // 8
+    BOARD_RECT = pygame.Rect(0, 0, SQUARE_SIZE * 8, SQUARE_SIZE * 8)
+    UI_RECT = pygame.Rect(0, BOARD_RECT.bottom, size[0], UI_HEIGHT)
+    screen.fill(BLACK)
+    invalidate_frame()
+
+
+def get_piece_image(piece, size):
+    image = piece_images.get((piece, size))
+    if image is None:
+        source = piece_sources.get(piece)
+        if source is None:
+            source = piece_sources[piece] = pygame.image.load(f'assets/{piece}.png').convert_alpha()
+        if len(piece_images) > 64:
+            piece_images.clear()
+        image = piece_images[(piece, size)] = pygame.transform.smoothscale(source, (size, size))
+    return image
+
+
+def render_text(text, small=False):
+    surface = text_cache.get((text, small))
+    if surface is None:
+        if len(text_cache) > 256:
+            text_cache.clear()
+        surface = text_cache[(text, small)] = render_font(text, small)
+    return surface
+
+
+def render_font(text, small=False):
+    return (analysis_font if small else font).render(text, True, WHITE)
+
+
+def get_board_background(theme):
+    background = board_backgrounds.get((theme, SQUARE_SIZE))
+    if background is None:
+        # At most one surface per theme, so resizing through many square sizes doesn't pile up full-board surfaces.
+        if len(board_backgrounds) >= len(THEMES):
+            board_backgrounds.clear()
+        background = pygame.Surface(BOARD_RECT.size)
+        colors = THEMES[theme]
+        for row in range(8):
+            for col in range(8):
+                color = colors[(row + col) % 2]
+                pygame.draw.rect(background, color, (col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))
+        board_backgrounds[(theme, SQUARE_SIZE)] = background
+    return background
+
+
+def draw_square(screen, theme, col, row, piece, highlighted, book_move):
+    rect = pygame.Rect(col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE)
+    screen.blit(get_board_background(theme), rect, rect)
+    if book_move:
+        draw_book_highlight(screen, rect)
+    if piece != '--':
+        screen.blit(get_piece_image(piece, SQUARE_SIZE), rect)
+    if highlighted:
+        pygame.draw.circle(screen, (255, 0, 0), rect.center, 10)
+    return rect
+
+
+def draw_book_highlight(screen, rect):
+    pygame.draw.rect(screen, (0, 0, 255), rect.inflate(-4, -4), 4)
 
 
 def draw_button(screen, text, x, y, w, h, color):
     pygame.draw.rect(screen, WHITE, (x, y, w, h), 2)
     pygame.draw.rect(screen, color, (x + 2, y + 2, w - 4, h - 4))
-    text_surf = font.render(text, True, WHITE)
+    text_surf = render_text(text)
     text_rect = text_surf.get_rect(center=(x + w // 2, y + h // 2))
     screen.blit(text_surf, text_rect)
 
 
 def draw_ui(screen, game_phase, turn, white_time, black_time, paused, game_over, message, promoting, promote_pos,
-            images):
+            vs_computer, engine_info, database_info, tablebase_info, eval_score, analysis_info):
     if game_phase == "pre_game":
-        draw_button(screen, "10m", 300, 850, 100, 50, (100, 100, 100))
-        draw_button(screen, "20m", 410, 850, 100, 50, (100, 100, 100))
-        draw_button(screen, "30m", 520, 850, 100, 50, (100, 100, 100))
-        draw_button(screen, "Start", 300, 920, 100, 50, (100, 100, 100))
+        draw_button(screen, "10m", 300, 50, 100, 50, (100, 100, 100))
+        draw_button(screen, "20m", 410, 50, 100, 50, (100, 100, 100))
+        draw_button(screen, "30m", 520, 50, 100, 50, (100, 100, 100))
+        draw_button(screen, "CPU", 630, 50, 100, 50, (0, 128, 0) if vs_computer else (100, 100, 100))
+        draw_button(screen, "Start", 300, 120, 100, 50, (100, 100, 100))
+        if message:
+            screen.blit(render_text(message), (50, 190))
     elif game_phase == "in_game":
-        draw_button(screen, "Restart", 50, 850, 100, 50, (100, 100, 100))
-        draw_button(screen, "Pause" if not paused else "Resume", 160, 850, 100, 50, (100, 100, 100))
-        draw_button(screen, "Theme", 270, 850, 100, 50, (100, 100, 100))
-        draw_button(screen, "Undo", 380, 850, 100, 50, (100, 100, 100))
-        draw_button(screen, "Redo", 490, 850, 100, 50, (100, 100, 100))
-        white_timer = font.render(f"White: {format_time(white_time)}", True, WHITE)
-        black_timer = font.render(f"Black: {format_time(black_time)}", True, WHITE)
-        screen.blit(white_timer, (600, 850))
-        screen.blit(black_timer, (600, 920))
+        draw_button(screen, "Restart", 50, 50, 100, 50, (100, 100, 100))
+        draw_button(screen, "Pause" if not paused else "Resume", 160, 50, 100, 50, (100, 100, 100))
+        draw_button(screen, "Theme", 270, 50, 100, 50, (100, 100, 100))
+        draw_button(screen, "Undo", 380, 50, 100, 50, (100, 100, 100))
+        draw_button(screen, "Redo", 490, 50, 100, 50, (100, 100, 100))
+        white_timer = render_text(f"White: {format_time(white_time)}")
+        black_timer = render_text(f"Black: {format_time(black_time)}")
+        screen.blit(white_timer, (600, 50))
+        screen.blit(black_timer, (600, 120))
         if message:
-            msg_text = font.render(message, True, WHITE)
-            screen.blit(msg_text, (300, 920))
+            msg_text = render_text(message)
+            screen.blit(msg_text, (300, 120))
         if promoting:
             color = 'w' if promote_pos[1] == 0 else 'b'
             pieces = [color + 'Q', color + 'R', color + 'B', color + 'N']
             for i, piece in enumerate(pieces):
-                screen.blit(images[piece], (300 + i * 100, 850))
-        turn_text = font.render(f"{turn.upper()}'s Turn", True, WHITE)
-        text_rect = turn_text.get_rect(center=(WIDTH // 2, 10))
-        pygame.draw.rect(screen, BLACK, (text_rect.x - 5, text_rect.y - 5, text_rect.width + 10, text_rect.height + 10))
-        screen.blit(turn_text, text_rect)
+                screen.blit(get_piece_image(piece, PROMOTION_SIZE), promotion_options[i])
+        if engine_info:
+            info_text = render_text(engine_info)
+            screen.blit(info_text, (50, 190))
+        if database_info:
+            screen.blit(render_text(database_info), (50, 230))
+        if tablebase_info:
+            screen.blit(render_text(tablebase_info), (50, 270))
+        if eval_score is not None:
+            draw_eval_bar(screen, eval_score)
+        # Three lines in the smaller font fit between the eval bar and the bottom of the panel.
+        for i, line in enumerate(analysis_info):
+            screen.blit(render_text(line, small=True), (50, EVAL_BAR_RECT.bottom + 8 + 24 * i))
+
+
+def draw_eval_bar(screen, score):
+    share = 0.5 + 0.5 * math.tanh(score / 600)
+    pygame.draw.rect(screen, (60, 60, 60), EVAL_BAR_RECT)
+    white_rect = EVAL_BAR_RECT.copy()
+    white_rect.width = round(EVAL_BAR_RECT.width * share)
+    pygame.draw.rect(screen, (230, 230, 230), white_rect)
+    pygame.draw.line(screen, (255, 0, 0), (EVAL_BAR_RECT.centerx, EVAL_BAR_RECT.top),
+                     (EVAL_BAR_RECT.centerx, EVAL_BAR_RECT.bottom - 1), 2)
+    text = render_text(f"{score / 100:+.2f}")
+    screen.blit(text, text.get_rect(midleft=(EVAL_BAR_RECT.right + 20, EVAL_BAR_RECT.centery)))
+
+
+def get_turn_banner_rect(turn):
+    text_rect = render_text(f"{turn.upper()}'s Turn").get_rect(center=(BOARD_RECT.centerx, 10))
+    return text_rect.inflate(10, 10)
+
+
+def draw_turn_banner(screen, turn):
+    turn_text = render_text(f"{turn.upper()}'s Turn")
+    text_rect = turn_text.get_rect(center=(BOARD_RECT.centerx, 10))
+    pygame.draw.rect(screen, BLACK, text_rect.inflate(10, 10))
+    screen.blit(turn_text, text_rect)
+
+
+def invalidate_frame():
+    global ui_key
+    square_keys[:] = [None] * 64
+    ui_key = None
+
+
+def render_frame(screen, highlights, book_squares):
+    global ui_key, first_frame_time
+    dirty = []
+    banner = turn if game_phase == "in_game" else None
+    banner_rect = get_turn_banner_rect(turn) if banner else None
+    banner_dirty = False
+    for sq in range(64):
+        col, row = sq % 8, sq // 8
+        under_banner = banner_rect is not None and banner_rect.colliderect(
+            (col * SQUARE_SIZE, row * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))
+        key = (theme, board.squares[sq], sq in highlights, sq in book_squares, banner if under_banner else None)
+        if square_keys[sq] != key:
+            square_keys[sq] = key
+            dirty.append(draw_square(screen, theme, col, row, piece_at(board, col, row), sq in highlights,
+                                     sq in book_squares))
+            banner_dirty = banner_dirty or under_banner
+    if banner_dirty:
+        draw_turn_banner(screen, turn)
+        dirty.append(banner_rect.clip(screen.get_rect()))
+
+    database_line, tablebase_line, eval_score = get_database_line(), get_tablebase_line(), get_eval_score()
+    key = (game_phase, paused, format_time(white_time), format_time(black_time), message, promoting,
+           promote_pos, vs_computer, engine_info, database_line, tablebase_line, eval_score, tuple(analysis_lines))
+    if key != ui_key:
+        ui_key = key
+        screen.fill(BLACK, UI_RECT)
+        draw_ui(screen.subsurface(UI_RECT), game_phase, turn, white_time, black_time, paused, game_over, message,
+                promoting, promote_pos, vs_computer, engine_info, database_line, tablebase_line, eval_score,
+                analysis_lines)
+        dirty.append(UI_RECT)
+    if show_profiler:
+        dirty.append(draw_profiler(screen))
+    if dirty:
+        pygame.display.update(dirty)
+        if first_frame_time is None:
+            first_frame_time = time.perf_counter() - STARTED
+
+
+def draw_profiler(screen):
+    global profiler_font
+    if profiler_font is None:
+        profiler_font = pygame.font.Font(None, 24)
+    lines = [f"fps {clock.get_fps():.0f}  first frame {1000 * first_frame_time:.0f} ms"] + profiler.lines()
+    rect = PROFILER_RECT.copy()
+    rect.height = 10 + 22 * len(lines)
+    screen.fill((20, 20, 20), rect)
+    for i, line in enumerate(lines):
+        screen.blit(profiler_font.render(line, True, (0, 255, 0)), (8, 6 + 22 * i))
+    return rect
+
+
+def toggle_profiler():
+    global show_profiler
+    show_profiler = not show_profiler
+    if show_profiler:
+        profiler.enable()
+    else:
+        profiler.disable()
+        invalidate_frame()
+
+
+def install_profiler():
+    profiler.hook(engine, "get_all_legal_moves", counter="moves generated")
+    profiler.hook(evaluator, "score", "evaluate")
+    for name in ("update_computer_move", "update_analysis", "get_book_squares", "render_frame", "draw_square",
+                 "draw_ui", "render_text"):
+        profiler.hook(globals(), name)
+    profiler.hook(globals(), "render_font", "font.render")
+    profiler.hook(pygame.display, "update", "display.update")
+    profiler.gauge("legal move cache", lambda: (move_cache.hits, move_cache.misses))
+    profiler.gauge("pawn table", lambda: (evaluator.pawns.hits, evaluator.pawns.misses))
+    profiler.gauge("text cache", lambda: (profiler.calls["render_text"] - profiler.calls["font.render"],
+                                          profiler.calls["font.render"]))
+    if PROFILE_FILE:
+        profiler.start_profile()
+    if TRACE_FILE:
+        profiler.start_trace()
+
+
+def stop_profiler():
+    if profiler.profile is not None:
+        profiler.dump_profile(PROFILE_FILE)
+    if profiler.trace is not None:
+        profiler.dump_trace(TRACE_FILE)
+        print(f"wrote trace to {TRACE_FILE}")
 
 
 def format_time(seconds):
@@ -124,253 +358,314 @@ def handle_mouse_click(board, selected_piece, selected_pos, turn, promoting, pro
         selected_pos = None
         return selected_piece, selected_pos, turn, promoting, promote_pos, attempted_move
     else:
-        if board[y][x][0] == turn:
-            selected_piece = board[y][x]
+        if piece_at(board, x, y)[0] == turn:
+            selected_piece = piece_at(board, x, y)
             selected_pos = (x, y)
         return selected_piece, selected_pos, turn, promoting, promote_pos, None
 
 
-def is_valid_move(board, piece, start_pos, end_pos, turn):
-    if piece == '--' or board[end_pos[1]][end_pos[0]][0] == turn:
-        return False
-    piece_type = piece[1]
-    if piece_type == 'P':
-        return is_valid_pawn_move(board, piece, start_pos, end_pos)
-    elif piece_type == 'R':
-        return is_valid_rook_move(board, start_pos, end_pos)
-    elif piece_type == 'N':
-        return is_valid_knight_move(start_pos, end_pos)
-    elif piece_type == 'B':
-        return is_valid_bishop_move(board, start_pos, end_pos)
-    elif piece_type == 'Q':
-        return is_valid_queen_move(board, start_pos, end_pos)
-    elif piece_type == 'K':
-        return is_valid_king_move(start_pos, end_pos)
-    return False
-
-
-def is_valid_pawn_move(board, piece, start_pos, end_pos):
-    direction = -1 if piece[0] == 'w' else 1
-    start_x, start_y = start_pos
-    end_x, end_y = end_pos
-    start_row = 6 if piece[0] == 'w' else 1
-    if start_x == end_x and board[end_y][end_x] == '--':
-        if end_y - start_y == direction:
-            return True
-        if start_y == start_row and end_y - start_y == 2 * direction and board[start_y + direction][start_x] == '--':
-            return True
-    if abs(start_x - end_x) == 1 and end_y - start_y == direction and board[end_y][end_x] != '--' and \
-            board[end_y][end_x][0] != piece[0]:
-        return True
-    return False
-
-
-def is_valid_rook_move(board, start_pos, end_pos):
-    start_x, start_y = start_pos
-    end_x, end_y = end_pos
-    if start_x != end_x and start_y != end_y:
-        return False
-    step_x = 0 if start_x == end_x else (1 if end_x > start_x else -1)
-    step_y = 0 if start_y == end_y else (1 if end_y > start_y else -1)
-    current_x, current_y = start_x + step_x, start_y + step_y
-    while (current_x, current_y) != (end_x, end_y):
-        if board[current_y][current_x] != '--':
-            return False
-        current_x += step_x
-        current_y += step_y
-    return True
-
-
-def is_valid_knight_move(start_pos, end_pos):
-    start_x, start_y = start_pos
-    end_x, end_y = end_pos
-    dx = abs(start_x - end_x)
-    dy = abs(start_y - end_y)
-    return (dx == 2 and dy == 1) or (dx == 1 and dy == 2)
-
-
-def is_valid_bishop_move(board, start_pos, end_pos):
-    start_x, start_y = start_pos
-    end_x, end_y = end_pos
-    if abs(start_x - end_x) != abs(start_y - end_y):
-        return False
-    step_x = 1 if end_x > start_x else -1
-    step_y = 1 if end_y > start_y else -1
-    current_x, current_y = start_x + step_x, start_y + step_y
-    while (current_x, current_y) != (end_x, end_y):
-        if board[current_y][current_x] != '--':
-            return False
-        current_x += step_x
-        current_y += step_y
-    return True
-
-
-def is_valid_queen_move(board, start_pos, end_pos):
-    return is_valid_rook_move(board, start_pos, end_pos) or is_valid_bishop_move(board, start_pos, end_pos)
-
-
-def is_valid_king_move(start_pos, end_pos):
-    start_x, start_y = start_pos
-    end_x, end_y = end_pos
-    dx = abs(start_x - end_x)
-    dy = abs(start_y - end_y)
-    return max(dx, dy) == 1
-
-
-def get_pseudo_legal_moves(board, player):
-    moves = []
-    for row in range(8):
-        for col in range(8):
-            if board[row][col][0] == player:
-                piece = board[row][col]
-                if piece[1] == 'P':
-                    piece_moves = get_pawn_moves(board, col, row, player)
-                elif piece[1] == 'R':
-                    piece_moves = get_rook_moves(board, col, row, player)
-                elif piece[1] == 'N':
-                    piece_moves = get_knight_moves(board, col, row, player)
-                elif piece[1] == 'B':
-                    piece_moves = get_bishop_moves(board, col, row, player)
-                elif piece[1] == 'Q':
-                    piece_moves = get_queen_moves(board, col, row, player)
-                elif piece[1] == 'K':
-                    piece_moves = get_king_moves(board, col, row, player)
-                else:
-                    piece_moves = []
-                for end_pos in piece_moves:
-                    moves.append(((col, row), end_pos))
-    return moves
-
-
-def get_pawn_moves(board, col, row, color):
-    moves = []
-    direction = -1 if color == 'w' else 1
-    start_row = 6 if color == 'w' else 1
-    if 0 <= row + direction < 8 and board[row + direction][col] == '--':
-        moves.append((col, row + direction))
-        if row == start_row and board[row + 2 * direction][col] == '--' and board[row + direction][col] == '--':
-            moves.append((col, row + 2 * direction))
-    if col > 0 and 0 <= row + direction < 8 and board[row + direction][col - 1][0] == ('b' if color == 'w' else 'w'):
-        moves.append((col - 1, row + direction))
-    if col < 7 and 0 <= row + direction < 8 and board[row + direction][col + 1][0] == ('b' if color == 'w' else 'w'):
-        moves.append((col + 1, row + direction))
-    return moves
-
-
-def get_rook_moves(board, col, row, color):
-    moves = []
-    directions = [(0, 1), (0, -1), (1, 0), (-1, 0)]
-    for dx, dy in directions:
-        x, y = col + dx, row + dy
-        while 0 <= x < 8 and 0 <= y < 8:
-            if board[y][x] == '--':
-                moves.append((x, y))
-            elif board[y][x][0] != color:
-                moves.append((x, y))
-                break
-            else:
-                break
-            x += dx
-            y += dy
-    return moves
-
-
-def get_knight_moves(board, col, row, color):
-    moves = []
-    knight_moves = [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)]
-    for dx, dy in knight_moves:
-        x, y = col + dx, row + dy
-        if 0 <= x < 8 and 0 <= y < 8 and (board[y][x] == '--' or board[y][x][0] != color):
-            moves.append((x, y))
-    return moves
-
-
-def get_bishop_moves(board, col, row, color):
-    moves = []
-    directions = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
-    for dx, dy in directions:
-        x, y = col + dx, row + dy
-        while 0 <= x < 8 and 0 <= y < 8:
-            if board[y][x] == '--':
-                moves.append((x, y))
-            elif board[y][x][0] != color:
-                moves.append((x, y))
-                break
-            else:
-                break
-            x += dx
-            y += dy
-    return moves
-
-
-def get_queen_moves(board, col, row, color):
-    return get_rook_moves(board, col, row, color) + get_bishop_moves(board, col, row, color)
-
-
-def get_king_moves(board, col, row, color):
+def update_game_status():
+    global message, game_over
+    legal_moves, in_check = move_cache.lookup(board)
+    message = "Check" if in_check else ""
+    outcome = get_outcome(board, legal_moves, in_check)
+    if outcome is not None:
+        result, reason = outcome
+        if reason == "checkmate":
+            message = f"Checkmate! {'White' if result == '1-0' else 'Black'} wins!"
+        else:
+            message = f"{reason.capitalize()}! Draw!"
+        game_over = True
+
+
+def get_database_line():
+    if position_index is None or game_phase != "in_game":
+        return ""
+    line = database_lines.get(board.hash)
+    if line is None:
+        legal_moves = move_cache.legal_moves(board)
+        entries = [(move, count) for move, count in position_index.moves(board.hash)[:3] if move in legal_moves]
+        line = "DB: " + "  ".join(f"{move_to_san(engine, board, move, legal_moves)} ({count})"
+                                  for move, count in entries) if entries else "DB: no games"
+        if len(database_lines) > 1024:
+            database_lines.clear()
+        database_lines[board.hash] = line
+    return line
+
+
+def get_eval_score():
+    if game_phase != "in_game":
+        return None
+    return evaluator.score(board)
+
+
+def get_tablebase_line():
+    if game_phase != "in_game":
+        return ""
+    line = tablebase_lines.get(board.hash)
+    if line is None:
+        result = tablebase.probe(board)
+        if result is None:
+            line = ""
+        elif result.wdl == 0:
+            line = "Tablebase: draw"
+        else:
+            winner = board.turn if result.wdl > 0 else ('b' if board.turn == 'w' else 'w')
+            line = f"Tablebase: {'White' if winner == 'w' else 'Black'} mates in {(result.dtm + 1) // 2}"
+        if len(tablebase_lines) > 1024:
+            tablebase_lines.clear()
+        tablebase_lines[board.hash] = line
+    return line
+
+
+def get_result():
+    if white_time <= 0:
+        return "0-1"
+    if black_time <= 0:
+        return "1-0"
+    outcome = get_outcome(board, *move_cache.lookup(board))
+    return outcome[0] if outcome else "*"
+
+
+def save_game(path):
+    global message
+    headers = {"White": "Computer" if vs_computer and COMPUTER == 'w' else "Human",
+               "Black": "Computer" if vs_computer and COMPUTER == 'b' else "Human",
+               "TimeControl": str(time_control)}
+    with open(path, "w") as f:
+        f.write(export_pgn(engine, history.moves(), headers, get_result(), start_position))
+    message = f"Saved {os.path.basename(path)}"
+
+
+def load_game(path):
+    global board, start_position, turn, message
+    try:
+        with open(path, "rb") as f:
+            game = next(read_games(f), None)
+            fen = game.headers.get("FEN") if game else None
+            start = from_fen(fen) if fen else Position(INITIAL_BOARD)
+            moves = [move for _, move in replay(engine, game)] if game else []
+    except (OSError, PgnError, ValueError) as error:
+        message = f"Could not load {os.path.basename(path)}"
+        print(f"{path}: {error}")
+        return
+    board = start
+    start_position = start.copy()
+    for move in moves:
+        history.push(board, move)
+    turn = board.turn
+    update_game_status()
+
+
+def get_analysis():
+    global analysis
+    if analysis is None:
+        analysis = AnalysisExecutor(ENGINE)
+    return analysis
+
+
+def update_computer_move():
+    analysis = get_analysis()
+    if paused or game_over or promoting:
+        analysis.cancel()
+        return
+    if not analysis.busy():
+        legal_moves = move_cache.legal_moves(board)
+        tablebase_move = tablebase.best_move(engine, board, legal_moves)
+        if tablebase_move is not None:
+            play_computer_move(tablebase_move, "Tablebase move")
+            return
+        book_move = opening_book.choose(board, legal_moves) if opening_book else None
+        if book_move is not None:
+            play_computer_move(book_move, "Book move")
+            return
+        analysis.submit(board, allocate_time(black_time if COMPUTER == 'b' else white_time))
+    result = analysis.poll()
+    if result is not None:
+        nps = result.nodes / result.elapsed if result.elapsed else 0
+        info = f"Depth {result.depth}  {format_score(result.score)}  {result.nodes} nodes  {nps:.0f} nps"
+        play_computer_move(result.move, info)
+
+
+def toggle_analysis():
+    global show_analysis
+    show_analysis = not show_analysis
+
+
+def update_analysis():
+    global analysis_key, analysis_lines
+    if not show_analysis or game_phase != "in_game" or game_over or (vs_computer and turn == COMPUTER):
+        if analysis is not None and analysis.pondering is not None:
+            analysis.cancel()
+        analysis_key = None
+        analysis_lines = []
+        return
+    # Undo, redo and new moves all change the key, which restarts the search on the worker's warm table.
+    key = (board.hash, history.ply)
+    if key != analysis_key:
+        analysis_key = key
+        analysis_lines = []
+        get_analysis().ponder(board, ANALYSIS_LINES)
+    best = analysis.poll_lines()
+    if best:
+        analysis_lines = [format_analysis_line(line) for line in best]
+
+
+def format_score(score):
+    # Search scores are from the side to move; show them from White's point of view.
+    score = score if board.turn == 'w' else -score
+    if abs(score) > MATE - 1000:
+        return f"{'+' if score > 0 else '-'}M{(MATE - abs(score) + 1) // 2}"
+    return f"{score / 100:+.2f}"
+
+
+def format_analysis_line(result):
+    position = board.copy()
     moves = []
-    for dx in [-1, 0, 1]:
-        for dy in [-1, 0, 1]:
-            if dx == 0 and dy == 0:
-                continue
-            x, y = col + dx, row + dy
-            if 0 <= x < 8 and 0 <= y < 8 and (board[y][x] == '--' or board[y][x][0] != color):
-                moves.append((x, y))
-    return moves
-
-
-def find_king_position(board, player):
-    for row in range(8):
-        for col in range(8):
-            if board[row][col] == player + 'K':
-                return (col, row)
-    return None
-
-
-def is_in_check(board, player):
-    king_pos = find_king_position(board, player)
-    if not king_pos:
-        return False
-    opponent = 'b' if player == 'w' else 'w'
-    opponent_moves = get_pseudo_legal_moves(board, opponent)
-    return any(move[1] == king_pos for move in opponent_moves)
-
-
-def get_all_legal_moves(board, player):
-    pseudo_moves = get_pseudo_legal_moves(board, player)
-    legal_moves = []
-    for start_pos, end_pos in pseudo_moves:
-        temp_board = copy.deepcopy(board)
-        temp_board[end_pos[1]][end_pos[0]] = temp_board[start_pos[1]][start_pos[0]]
-        temp_board[start_pos[1]][start_pos[0]] = '--'
-        if temp_board[end_pos[1]][end_pos[0]][1] == 'P' and (end_pos[1] == 0 or end_pos[1] == 7):
-            temp_board[end_pos[1]][end_pos[0]] = player + 'Q'
-        if not is_in_check(temp_board, player):
-            legal_moves.append((start_pos, end_pos))
-    return legal_moves
+    for move in result.pv[:6]:
+        moves.append(move_to_san(engine, position, move))
+        position.make_move(move)
+    return f"{result.depth:>2}  {format_score(result.score)}  {' '.join(moves)}"
+
+
+def get_book_squares():
+    if opening_book is None or game_phase != "in_game":
+        return set()
+    moves = [move for move, _ in opening_book.legal_moves(board, move_cache.legal_moves(board))]
+    if selected_pos:
+        start = selected_pos[1] * 8 + selected_pos[0]
+        return {(move >> 6) & 63 for move in moves if move & 63 == start}
+    return {move & 63 for move in moves}
+
+
+def play_computer_move(move, info):
+    global turn, engine_info
+    engine_info = info
+    if move is None:
+        return
+    history.push(board, move, white_time, black_time)
+    turn = board.turn
+    update_game_status()
+
+
+def navigate(ply):
+    global turn, selected_piece, selected_pos, white_time, black_time, game_over, live_clocks
+    if SERVER:
+        return
+    if analysis is not None:
+        analysis.cancel()
+    if history.ply == len(history.records):
+        live_clocks = (white_time, black_time)
+    direction = -1 if ply < history.ply else 1
+    history.jump_to(board, ply)
+    if vs_computer and board.turn == COMPUTER:
+        history.jump_to(board, history.ply + direction)
+        # Stuck at the start of the log: the computer would play over the redo moves, so step back towards them.
+        if board.turn == COMPUTER and history.ply < len(history.records):
+            history.jump_to(board, history.ply - direction)
+    # Each record holds the clocks as they stood when its move was played, i.e. when its position was on the board.
+    if history.ply < len(history.records):
+        record = history.records[history.ply]
+        if record.white_time is not None:
+            white_time, black_time = record.white_time, record.black_time
+    elif live_clocks is not None:
+        white_time, black_time = live_clocks
+    turn = board.turn
+    selected_piece = None
+    selected_pos = None
+    game_over = False
+    update_game_status()
 
 
 def reset_game():
-    global board, turn, selected_piece, selected_pos, history, redo_stack, white_time, black_time, game_over, message, promoting
-    board = copy.deepcopy(INITIAL_BOARD)
+    global board, start_position, live_clocks, turn, selected_piece, selected_pos, history, white_time, black_time, game_over, message, promoting, engine_info
+    if analysis is not None:
+        analysis.cancel()
+    board = Position(INITIAL_BOARD)
+    start_position = board.copy()
+    live_clocks = None
     turn = 'w'
     selected_piece = None
     selected_pos = None
-    history = []
-    redo_stack = []
+    history = MoveLog()
     white_time = time_control
     black_time = time_control
     game_over = False
     message = ""
     promoting = False
-
-
-board = copy.deepcopy(INITIAL_BOARD)
+    engine_info = ""
+    if PGN_FILE and client is None:
+        load_game(PGN_FILE)
+
+
+def play_move(move):
+    global turn
+    if client is not None:
+        client.send(PlayMove(move))
+        return
+    history.push(board, move, white_time, black_time)
+    turn = board.turn
+    update_game_status()
+
+
+async def join_server(time_control):
+    global client, message
+    host, _, port = SERVER.rpartition(":")
+    message = "Connecting..."
+    try:
+        client = await connect(host or "localhost", int(port))
+    except (OSError, ValueError) as error:
+        message = f"Could not connect to {SERVER}"
+        print(f"{SERVER}: {error}")
+        return
+    client.send(Join(time_control))
+    message = "Waiting for an opponent..."
+
+
+def poll_server():
+    global client, game_phase, vs_computer, player_color, white_time, black_time, turn, game_over, message
+    while client.messages:
+        update = client.messages.popleft()
+        if isinstance(update, Started):
+            reset_game()
+            game_phase, vs_computer = "in_game", False
+            player_color = 'w' if update.color == 0 else 'b'
+            white_time, black_time = update.white_ms / 1000, update.black_ms / 1000
+            message = f"You play {'White' if player_color == 'w' else 'Black'}"
+        elif isinstance(update, Moved):
+            white_time, black_time = update.white_ms / 1000, update.black_ms / 1000
+            history.push(board, update.move, white_time, black_time)
+            turn = board.turn
+            update_game_status()
+        elif isinstance(update, Rejected):
+            message = "Move rejected"
+        elif isinstance(update, Ended):
+            result, reason = RESULTS[update.result], REASONS[update.reason]
+            winner = "White" if result == "1-0" else "Black"
+            if result == "1/2-1/2":
+                message = f"{reason.capitalize()}! Draw!"
+            elif reason == "checkmate":
+                message = f"Checkmate! {winner} wins!"
+            elif reason == "time":
+                message = f"Time's up! {winner} wins!"
+            else:
+                message = f"{winner} wins by {reason}!"
+            game_over = True
+            client.close()
+    if client.closed:
+        client = None
+        if game_phase == "in_game" and not game_over:
+            game_over = True
+            message = "Connection lost"
+
+
+board = Position(INITIAL_BOARD)
+start_position = board.copy()
+live_clocks = None
 selected_piece = None
 selected_pos = None
 turn = 'w'
-history = []
-redo_stack = []
+history = MoveLog()
 time_control = 600
 white_time = time_control
 black_time = time_control
@@ -379,127 +674,137 @@ game_over = False
 message = ""
 promoting = False
 promote_pos = None
+promote_move = None
 theme = 0
 game_phase = "pre_game"
-promotion_options = [(300, 850), (400, 850), (500, 850), (600, 850)]
+vs_computer = False
+engine_info = ""
+promotion_options = [(300, 50), (400, 50), (500, 50), (600, 50)]
 
 
 async def main():
-    global board, selected_piece, selected_pos, turn, paused, game_over, message, promoting, promote_pos, theme, time_control, white_time, black_time, game_phase
-    images = load_images()
+    global board, selected_piece, selected_pos, turn, paused, game_over, message, promoting, promote_pos, promote_move, theme, time_control, white_time, black_time, game_phase, vs_computer, server_task
+    init_display()
+    install_profiler()
     while True:
         delta = clock.tick(FPS) / 1000.0
+        profiler.begin_frame()
         if game_phase == "in_game" and not paused and not game_over and not promoting:
             if turn == 'w':
                 white_time -= delta
-                if white_time <= 0:
+                if white_time <= 0 and client is None:
                     white_time = 0
                     game_over = True
                     message = "Time's up! Black wins!"
             else:
                 black_time -= delta
-                if black_time <= 0:
+                if black_time <= 0 and client is None:
                     black_time = 0
                     game_over = True
                     message = "Time's up! White wins!"
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                return
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                mouse_pos = event.pos
-                if game_phase == "pre_game":
-                    x, y = mouse_pos
-                    if 300 <= x <= 400 and 850 <= y <= 900:
-                        time_control = 600
-                    elif 410 <= x <= 510 and 850 <= y <= 900:
-                        time_control = 1200
-                    elif 520 <= x <= 620 and 850 <= y <= 900:
-                        time_control = 1800
-                    elif 300 <= x <= 400 and 920 <= y <= 970:
-                        reset_game()
-                        game_phase = "in_game"
-                elif game_phase == "in_game":
-                    if promoting:
-                        for i, (px, py) in enumerate(promotion_options):
-                            if px <= mouse_pos[0] < px + SQUARE_SIZE and py <= mouse_pos[1] < py + SQUARE_SIZE:
-                                promo_type = ['Q', 'R', 'B', 'N'][i]
-                                color = 'w' if promote_pos[1] == 0 else 'b'
-                                board[promote_pos[1]][promote_pos[0]] = color + promo_type
-                                promoting = False
-                                turn = 'b' if turn == 'w' else 'w'
-                                if is_in_check(board, turn):
-                                    message = "Check"
-                                    legal_moves = get_all_legal_moves(board, turn)
-                                    if not legal_moves:
-                                        winner = "White" if turn == 'b' else "Black"
-                                        message = f"Checkmate! {winner} wins!"
-                                        game_over = True
-                                else:
-                                    message = ""
-                                    legal_moves = get_all_legal_moves(board, turn)
-                                    if not legal_moves:
-                                        message = "Stalemate! Draw!"
-                                        game_over = True
-                                break
-                    else:
-                        if mouse_pos[1] < 800 and not game_over and not paused:
-                            selected_piece, selected_pos, turn, promoting, promote_pos, attempted_move = handle_mouse_click(
-                                board, selected_piece, selected_pos, turn, promoting, promote_pos)
-                            if attempted_move:
-                                legal_moves = get_all_legal_moves(board, turn)
-                                if attempted_move in legal_moves:
-                                    start_pos, end_pos = attempted_move
-                                    history.append((copy.deepcopy(board), turn))
-                                    board[end_pos[1]][end_pos[0]] = board[start_pos[1]][start_pos[0]]
-                                    board[start_pos[1]][start_pos[0]] = '--'
-                                    if board[end_pos[1]][end_pos[0]][1] == 'P' and (end_pos[1] == 0 or end_pos[1] == 7):
-                                        promoting = True
-                                        promote_pos = end_pos
-                                    else:
-                                        turn = 'b' if turn == 'w' else 'w'
-                                        if is_in_check(board, turn):
-                                            message = "Check"
-                                            legal_moves = get_all_legal_moves(board, turn)
-                                            if not legal_moves:
-                                                winner = "White" if turn == 'b' else "Black"
-                                                message = f"Checkmate! {winner} wins!"
-                                                game_over = True
-                                        else:
-                                            message = ""
-                                            legal_moves = get_all_legal_moves(board, turn)
-                                            if not legal_moves:
-                                                message = "Stalemate! Draw!"
-                                                game_over = True
-                        if mouse_pos[1] >= 800:
-                            x, y = mouse_pos
-                            if 50 <= x <= 150 and 850 <= y <= 900:
+        with profiler.section("events"):
+            for event in pygame.event.get():
+                if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                    invalidate_frame()
+                elif event.type == pygame.VIDEORESIZE:
+                    resize_window(event.w, event.h)
+                elif event.type == pygame.QUIT:
+                    if analysis is not None:
+                        analysis.shutdown()
+                    if client is not None:
+                        client.close()
+                    stop_profiler()
+                    return
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                    toggle_profiler()
+                elif event.type == pygame.KEYDOWN and game_phase == "in_game" and not promoting:
+                    if event.key == pygame.K_LEFT and history.can_undo():
+                        navigate(history.ply - 1)
+                    elif event.key == pygame.K_RIGHT and history.can_redo():
+                        navigate(history.ply + 1)
+                    elif event.key == pygame.K_HOME:
+                        navigate(0)
+                    elif event.key == pygame.K_END:
+                        navigate(len(history.records))
+                    elif event.key == pygame.K_s:
+                        save_game(SAVE_FILE)
+                    elif event.key == pygame.K_a:
+                        toggle_analysis()
+                elif event.type == pygame.MOUSEBUTTONDOWN:
+                    mouse_pos = event.pos
+                    x, y = mouse_pos[0] - UI_RECT.left, mouse_pos[1] - UI_RECT.top
+                    if game_phase == "pre_game":
+                        if 300 <= x <= 400 and 50 <= y <= 100:
+                            time_control = 600
+                        elif 410 <= x <= 510 and 50 <= y <= 100:
+                            time_control = 1200
+                        elif 520 <= x <= 620 and 50 <= y <= 100:
+                            time_control = 1800
+                        elif 630 <= x <= 730 and 50 <= y <= 100:
+                            vs_computer = not vs_computer
+                        elif 300 <= x <= 400 and 120 <= y <= 170:
+                            if not SERVER:
                                 reset_game()
-                            elif 160 <= x <= 260 and 850 <= y <= 900:
-                                paused = not paused
-                            elif 270 <= x <= 370 and 850 <= y <= 900:
-                                theme = (theme + 1) % len(THEMES)
-                            elif 380 <= x <= 480 and 850 <= y <= 900 and history:
-                                redo_stack.append((copy.deepcopy(board), turn))
-                                board, turn = history.pop()
-                                selected_piece = None
-                                selected_pos = None
-                            elif 490 <= x <= 590 and 850 <= y <= 900 and redo_stack:
-                                history.append((copy.deepcopy(board), turn))
-                                board, turn = redo_stack.pop()
-                                selected_piece = None
-                                selected_pos = None
-
-        screen.fill(BLACK)
-        if game_phase in ["pre_game", "in_game"]:
-            draw_board(screen, theme)
-            draw_pieces(screen, board, images)
+                                game_phase = "in_game"
+                            elif client is None and (server_task is None or server_task.done()):
+                                server_task = asyncio.ensure_future(join_server(time_control))
+                    elif game_phase == "in_game":
+                        if promoting:
+                            for i, (px, py) in enumerate(promotion_options):
+                                if px <= x < px + PROMOTION_SIZE and py <= y < py + PROMOTION_SIZE:
+                                    promo_type = [QUEEN, ROOK, BISHOP, KNIGHT][i]
+                                    promoting = False
+                                    play_move((promote_move & 0xFFF) | (promo_type << 12))
+                                    break
+                        else:
+                            opponent_to_move = ((vs_computer and turn == COMPUTER) or
+                                                (client is not None and turn != player_color))
+                            if BOARD_RECT.collidepoint(mouse_pos) and not (game_over or paused or opponent_to_move):
+                                (selected_piece, selected_pos, turn, promoting, promote_pos,
+                                 attempted_move) = handle_mouse_click(board, selected_piece, selected_pos, turn,
+                                                                      promoting, promote_pos)
+                                if attempted_move:
+                                    legal_moves = move_cache.legal_moves(board)
+                                    move = next((m for m in legal_moves if move_to_coords(m) == attempted_move), None)
+                                    if move is not None:
+                                        if move >> 12 != EMPTY:
+                                            promoting = True
+                                            promote_pos = attempted_move[1]
+                                            promote_move = move
+                                        else:
+                                            play_move(move)
+                            if UI_RECT.collidepoint(mouse_pos):
+                                if 50 <= x <= 150 and 50 <= y <= 100:
+                                    if client is not None:
+                                        client.send(Resign())
+                                    elif SERVER:
+                                        # Back to the lobby, where Start joins the next server game.
+                                        game_phase = "pre_game"
+                                        message = ""
+                                    else:
+                                        reset_game()
+                                elif 160 <= x <= 260 and 50 <= y <= 100 and not SERVER:
+                                    paused = not paused
+                                elif 270 <= x <= 370 and 50 <= y <= 100:
+                                    theme = (theme + 1) % len(THEMES)
+                                elif 380 <= x <= 480 and 50 <= y <= 100 and history.can_undo():
+                                    navigate(history.ply - 1)
+                                elif 490 <= x <= 590 and 50 <= y <= 100 and history.can_redo():
+                                    navigate(history.ply + 1)
+
+        if client is not None:
+            poll_server()
+        if game_phase == "in_game" and vs_computer and turn == COMPUTER:
+            update_computer_move()
+        update_analysis()
+
+        highlights = set()
         if game_phase == "in_game" and selected_pos:
-            moves = [move for move in get_all_legal_moves(board, turn) if move[0] == selected_pos]
-            draw_highlights(screen, moves)
-        draw_ui(screen, game_phase, turn, white_time, black_time, paused, game_over, message, promoting, promote_pos,
-                images)
-        pygame.display.flip()
+            start = selected_pos[1] * 8 + selected_pos[0]
+            highlights = {(move >> 6) & 63 for move in move_cache.legal_moves(board) if move & 63 == start}
+        render_frame(screen, highlights, get_book_squares())
+        profiler.end_frame()
         await asyncio.sleep(1.0 / FPS)
 
 
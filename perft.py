@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from rules import ENGINES, compute_hash, compute_score, from_fen, load_engine, move_to_coords
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "perft_baseline.json")
+
+# Standard test positions with their published node counts (depth 1, 2, 3, ...).
+PERFT_POSITIONS = {
+    "startpos": ("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+                 [20, 400, 8902, 197281, 4865609]),
+    "kiwipete": ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+                 [48, 2039, 97862, 4085603]),
+    "position3": ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+                  [14, 191, 2812, 43238, 674624]),
+    "position4": ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+                  [6, 264, 9467, 422333]),
+    "position5": ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+                  [44, 1486, 62379, 2103487]),
+    "position6": ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+                  [46, 2079, 89890, 3894594]),
+}
+DEFAULT_DEPTHS = {"startpos": 4, "kiwipete": 3, "position3": 5, "position4": 4, "position5": 3, "position6": 3}
+
+
+def move_name(move):
+    (start_x, start_y), (end_x, end_y) = move_to_coords(move)
+    name = f"{'abcdefgh'[start_x]}{8 - start_y}{'abcdefgh'[end_x]}{8 - end_y}"
+    if move >> 12:
+        name += ' pnbrqk'[move >> 12]
+    return name
+
+
+def perft(engine, position, depth):
+    moves = engine.get_all_legal_moves(position, position.turn)
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        position.make_move(move)
+        nodes += perft(engine, position, depth - 1)
+        position.unmake_move()
+    return nodes
+
+
+def divide(engine, position, depth):
+    counts = {}
+    for move in engine.get_all_legal_moves(position, position.turn):
+        position.make_move(move)
+        counts[move_name(move)] = perft(engine, position, depth - 1) if depth > 1 else 1
+        position.unmake_move()
+    return counts
+
+
+def _state(position):
+    return (bytes(position.squares), position.turn, position.castling, position.ep_square, position.halfmove_clock,
+            position.fullmove_number, position.hash, position.score, tuple(position.bitboards),
+            tuple(position.occupancy.items()), tuple(position.kings.items()))
+
+
+def verify(engine, position, depth, line=()):
+    # The hash and piece-square score kept up to date by make_move must match a full recomputation at every node,
+    # and unmake_move must restore the previous state exactly. Returns the moves leading to the first failure and
+    # what failed, or None.
+    if position.hash != compute_hash(position):
+        return line, "hash"
+    if position.score != compute_score(position):
+        return line, "score"
+    if depth == 0:
+        return None
+    state = _state(position)
+    for move in engine.get_all_legal_moves(position, position.turn):
+        position.make_move(move)
+        failure = verify(engine, position, depth - 1, line + (move,))
+        position.unmake_move()
+        if failure is None and _state(position) != state:
+            failure = line + (move,), "unmake"
+        if failure is not None:
+            return failure
+    return None
+
+
+def run_position(engine, fen, depth):
+    position = from_fen(fen)
+    started = time.perf_counter()
+    nodes = perft(engine, position, depth)
+    elapsed = time.perf_counter() - started
+    return nodes, elapsed
+
+
+def load_baseline():
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+
+def save_baseline(baseline):
+    with open(BASELINE_FILE, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count and time move generation (perft).")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="bitboard")
+    parser.add_argument("--position", default=None,
+                        help="name of a standard position or a FEN string (default: all standard positions)")
+    parser.add_argument("--depth", type=int, default=None)
+    parser.add_argument("--divide", action="store_true", help="break the node count down by root move")
+    parser.add_argument("--verify", action="store_true",
+                        help="check incremental state against a full recomputation at every node (default depth 3)")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help=f"record counts and speed in {os.path.basename(BASELINE_FILE)}")
+    args = parser.parse_args(argv)
+    engine = load_engine(args.engine)
+
+    if args.position in PERFT_POSITIONS or args.position is None:
+        names = [args.position] if args.position else list(PERFT_POSITIONS)
+        jobs = [(name, PERFT_POSITIONS[name][0], PERFT_POSITIONS[name][1]) for name in names]
+    else:
+        jobs = [(args.position, args.position, [])]
+
+    if args.divide:
+        name, fen, _ = jobs[0]
+        depth = args.depth or DEFAULT_DEPTHS.get(name, 3)
+        counts = divide(engine, from_fen(fen), depth)
+        for move in sorted(counts):
+            print(f"{move}: {counts[move]}")
+        print(f"\nMoves: {len(counts)}\nNodes: {sum(counts.values())}")
+        return 0
+
+    if args.verify:
+        failed = False
+        for name, fen, _ in jobs:
+            depth = args.depth or 3
+            failure = verify(engine, from_fen(fen), depth)
+            if failure is None:
+                print(f"{name:<10} depth {depth}  ok")
+            else:
+                line, what = failure
+                moves = ' '.join(map(move_name, line)) or 'start'
+                print(f"{name:<10} depth {depth}  {what.upper()} MISMATCH after {moves}")
+                failed = True
+        return 1 if failed else 0
+
+    baseline = load_baseline()
+    failed = False
+    total_nodes = 0
+    total_time = 0.0
+    for name, fen, reference in jobs:
+        depth = args.depth or DEFAULT_DEPTHS.get(name, 3)
+        nodes, elapsed = run_position(engine, fen, depth)
+        total_nodes += nodes
+        total_time += elapsed
+        nps = nodes / elapsed if elapsed else 0.0
+        line = f"{name:<10} depth {depth}  nodes {nodes:>9}  {elapsed:7.2f}s  {nps:>10.0f} nps"
+
+        entry = baseline.get(name)
+        if entry and entry["fen"] == fen and str(depth) in entry["counts"]:
+            expected = entry["counts"][str(depth)]
+            if nodes != expected:
+                line += f"  MISMATCH (baseline {expected})"
+                failed = True
+            base_nps = entry.get("nodes_per_second", {}).get(args.engine)
+            if base_nps:
+                line += f"  {100.0 * (nps - base_nps) / base_nps:+.0f}% vs baseline"
+        if len(reference) >= depth and reference[depth - 1] != nodes:
+            line += f"  (published {reference[depth - 1]})"
+        print(line)
+
+        if args.update_baseline:
+            entry = baseline.setdefault(name, {"fen": fen, "counts": {}, "nodes_per_second": {}})
+            if entry["fen"] != fen:
+                entry.update(fen=fen, counts={}, nodes_per_second={})
+            entry["counts"][str(depth)] = nodes
+            entry["nodes_per_second"][args.engine] = round(nps)
+
+    if total_time:
+        print(f"total      nodes {total_nodes}  {total_time:.2f}s  {total_nodes / total_time:.0f} nps")
+    if args.update_baseline:
+        save_baseline(baseline)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import re
+from collections import namedtuple
+
+from rules import PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, Position, from_fen, to_fen
+
+PgnGame = namedtuple("PgnGame", "headers movetext offset")
+
+FILES = "abcdefgh"
+PIECE_LETTERS = {KNIGHT: 'N', BISHOP: 'B', ROOK: 'R', QUEEN: 'Q', KING: 'K'}
+LETTER_PIECES = {letter: kind for kind, letter in PIECE_LETTERS.items()}
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+SEVEN_TAG_ROSTER = ("Event", "Site", "Date", "Round", "White", "Black", "Result")
+
+_HEADER_RE = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+_TOKEN_RE = re.compile(r'\{[^}]*\}|;[^\n]*|\(|\)|\$\d+|\d+\.(?:\.\.)?|[^\s(){};]+')
+
+
+class PgnError(ValueError):
+    pass
+
+
+def square_name(sq):
+    return f"{FILES[sq % 8]}{8 - sq // 8}"
+
+
+def parse_square(name):
+    return (8 - int(name[1])) * 8 + FILES.index(name[0])
+
+
+def move_to_san(engine, position, move, legal_moves=None):
+    if legal_moves is None:
+        legal_moves = engine.get_all_legal_moves(position, position.turn)
+    squares = position.squares
+    start, end, promotion = move & 63, (move >> 6) & 63, move >> 12
+    piece = squares[start]
+    kind = piece & 7
+    capture = squares[end] != 0 or (kind == PAWN and start % 8 != end % 8)
+    if kind == KING and abs(start % 8 - end % 8) == 2:
+        san = "O-O" if end % 8 == 6 else "O-O-O"
+    elif kind == PAWN:
+        san = (FILES[start % 8] + 'x' if capture else '') + square_name(end)
+        if promotion:
+            san += '=' + PIECE_LETTERS[promotion]
+    else:
+        rivals = [m & 63 for m in legal_moves
+                  if (m >> 6) & 63 == end and m & 63 != start and squares[m & 63] == piece]
+        prefix = ''
+        if rivals:
+            if all(r % 8 != start % 8 for r in rivals):
+                prefix = FILES[start % 8]
+            elif all(r // 8 != start // 8 for r in rivals):
+                prefix = str(8 - start // 8)
+            else:
+                prefix = square_name(start)
+        san = PIECE_LETTERS[kind] + prefix + ('x' if capture else '') + square_name(end)
+    position.make_move(move)
+    if engine.is_in_check(position, position.turn):
+        san += '#' if not engine.get_all_legal_moves(position, position.turn) else '+'
+    position.unmake_move()
+    return san
+
+
+def parse_san(engine, position, san, legal_moves=None):
+    if legal_moves is None:
+        legal_moves = engine.get_all_legal_moves(position, position.turn)
+    squares = position.squares
+    text = san.rstrip('+#!?')
+    if text.replace('0', 'O') in ("O-O", "O-O-O"):
+        target_file = 6 if text.replace('0', 'O') == "O-O" else 2
+        for move in legal_moves:
+            start, end = move & 63, (move >> 6) & 63
+            if squares[start] & 7 == KING and start % 8 == 4 and end % 8 == target_file:
+                return move
+        raise PgnError(f"Illegal castling {san!r}")
+
+    promotion = 0
+    if '=' in text:
+        text, letter = text.split('=', 1)
+        promotion = LETTER_PIECES.get(letter[:1].upper(), 0)
+    elif len(text) > 2 and text[-1].upper() in "NBRQ" and text[-2].isdigit():
+        promotion = LETTER_PIECES[text[-1].upper()]
+        text = text[:-1]
+    kind = PAWN
+    if text[:1] in LETTER_PIECES:
+        kind = LETTER_PIECES[text[0]]
+        text = text[1:]
+    text = text.replace('x', '').replace('-', '')
+    if len(text) < 2 or text[-2] not in FILES or text[-1] not in "12345678":
+        raise PgnError(f"Cannot parse move {san!r}")
+    end = parse_square(text[-2:])
+    hint = text[:-2]
+
+    matches = []
+    for move in legal_moves:
+        start = move & 63
+        if (move >> 6) & 63 != end or squares[start] & 7 != kind:
+            continue
+        if kind == PAWN and promotion and move >> 12 != promotion:
+            continue
+        if any((c in FILES and FILES[start % 8] != c) or (c.isdigit() and str(8 - start // 8) != c) for c in hint):
+            continue
+        matches.append(move)
+    if len(matches) != 1:
+        raise PgnError(f"{'Ambiguous' if matches else 'Illegal'} move {san!r} in {to_fen(position)}")
+    return matches[0]
+
+
+def iter_san_tokens(movetext):
+    depth = 0
+    for match in _TOKEN_RE.finditer(movetext):
+        token = match.group()
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth = max(0, depth - 1)
+        elif depth or token[0] in '{;$' or token[0].isdigit() and token.rstrip('.').isdigit():
+            continue
+        elif token in RESULTS:
+            return
+        else:
+            yield token
+
+
+def read_games(stream):
+    headers = {}
+    movetext = []
+    offset = 0
+    game_offset = None
+    for raw in stream:
+        line_offset = offset
+        offset += len(raw)
+        line = raw.decode("utf-8", "replace").strip() if isinstance(raw, bytes) else raw.strip()
+        if line.startswith('['):
+            if movetext:
+                yield PgnGame(headers, ' '.join(movetext), game_offset)
+                headers, movetext, game_offset = {}, [], None
+            match = _HEADER_RE.match(line)
+            if match:
+                if game_offset is None:
+                    game_offset = line_offset
+                headers[match.group(1)] = re.sub(r'\\(.)', r'\1', match.group(2))
+        elif line and not line.startswith('%'):
+            if game_offset is None:
+                game_offset = line_offset
+            movetext.append(line)
+    if headers or movetext:
+        yield PgnGame(headers, ' '.join(movetext), game_offset)
+
+
+def replay(engine, game):
+    fen = game.headers.get("FEN")
+    position = from_fen(fen) if fen else Position()
+    for san in iter_san_tokens(game.movetext):
+        move = parse_san(engine, position, san)
+        yield position, move
+        position.make_move(move)
+
+
+def export_pgn(engine, moves, headers=None, result="*", position=None):
+    position = position.copy() if position else Position()
+    start_fen = to_fen(position)
+    headers = dict(headers or {})
+    headers["Result"] = result
+    for tag in SEVEN_TAG_ROSTER:
+        headers.setdefault(tag, "?")
+    if start_fen != to_fen(Position()):
+        headers["SetUp"] = "1"
+        headers["FEN"] = start_fen
+    ordered = list(SEVEN_TAG_ROSTER) + [tag for tag in headers if tag not in SEVEN_TAG_ROSTER]
+    lines = []
+    for tag in ordered:
+        value = str(headers[tag]).replace('\\', '\\\\').replace('"', '\\"')
+        lines.append(f'[{tag} "{value}"]')
+
+    tokens = []
+    number = 1
+    for i, move in enumerate(moves):
+        if position.turn == 'w':
+            tokens.append(f"{number}.")
+        elif i == 0:
+            tokens.append(f"{number}...")
+        tokens.append(move_to_san(engine, position, move))
+        if position.turn == 'b':
+            number += 1
+        position.make_move(move)
+    tokens.append(result)
+
+    movetext = []
+    line = ''
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > 79:
+            movetext.append(line)
+            line = token
+        else:
+            line = f"{line} {token}" if line else token
+    movetext.append(line)
+    return '\n'.join(lines) + '\n\n' + '\n'.join(movetext) + '\n'
@@ -0,0 +1,182 @@
+import argparse
+import heapq
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from perft import move_name
+from pgn import PgnError, read_games, replay
+from rules import ENGINES, Position, from_fen, load_engine
+
+MAGIC = b"CPIX"
+VERSION = 2
+HEADER = struct.Struct("<4sIQQ")
+RUN_RECORD = struct.Struct("<QHQ")
+REPEATED = (1 << 64) - 1
+MOVE_RECORD = struct.Struct("<QHI")
+GAME_RECORD = struct.Struct("<QQ")
+
+
+def bisect_records(buffer, base, count, record_size, key):
+    # Index of the first fixed-width record whose leading little-endian u64 is >= key.
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if int.from_bytes(buffer[base + middle * record_size:base + middle * record_size + 8], "little") < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _write_run(records, directory):
+    records.sort()
+    run = tempfile.TemporaryFile(dir=directory)
+    for record in records:
+        run.write(RUN_RECORD.pack(*record))
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    size = RUN_RECORD.size
+    while True:
+        chunk = run.read(size * 4096)
+        if not chunk:
+            return
+        yield from RUN_RECORD.iter_unpack(chunk)
+
+
+def build_index(pgn_path, index_path, engine, max_plies=None, run_size=1 << 20):
+    directory = os.path.dirname(os.path.abspath(index_path))
+    runs = []
+    records = []
+    stats = {"games": 0, "positions": 0, "skipped": 0}
+    with open(pgn_path, "rb") as stream:
+        for game in read_games(stream):
+            entries = []
+            seen = set()
+            try:
+                for ply, (position, move) in enumerate(replay(engine, game)):
+                    if max_plies is not None and ply >= max_plies:
+                        break
+                    # A position repeated within one game counts its moves again but references the game once.
+                    entries.append((position.hash, move, REPEATED if position.hash in seen else game.offset))
+                    seen.add(position.hash)
+            except PgnError:
+                stats["skipped"] += 1
+                continue
+            stats["games"] += 1
+            stats["positions"] += len(entries)
+            records.extend(entries)
+            if len(records) >= run_size:
+                runs.append(_write_run(records, directory))
+                records = []
+    if records:
+        runs.append(_write_run(records, directory))
+
+    # Merge the sorted runs, aggregating move counts and de-duplicating game references.
+    moves_file = tempfile.TemporaryFile(dir=directory)
+    games_file = tempfile.TemporaryFile(dir=directory)
+    move_count = game_count = 0
+    current_move = None
+    count = 0
+    last_game = None
+    for key, move, offset in heapq.merge(*(_read_run(run) for run in runs)):
+        if (key, move) != current_move:
+            if current_move is not None:
+                moves_file.write(MOVE_RECORD.pack(current_move[0], current_move[1], count))
+                move_count += 1
+            current_move = (key, move)
+            count = 0
+        count += 1
+        if offset != REPEATED and (key, offset) != last_game:
+            games_file.write(GAME_RECORD.pack(key, offset))
+            game_count += 1
+            last_game = (key, offset)
+    if current_move is not None:
+        moves_file.write(MOVE_RECORD.pack(current_move[0], current_move[1], count))
+        move_count += 1
+    for run in runs:
+        run.close()
+
+    with open(index_path, "wb") as out:
+        out.write(HEADER.pack(MAGIC, VERSION, move_count, game_count))
+        for section in (moves_file, games_file):
+            section.seek(0)
+            while True:
+                chunk = section.read(1 << 20)
+                if not chunk:
+                    break
+                out.write(chunk)
+            section.close()
+    return stats
+
+
+class PositionIndex:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.move_count, self.game_count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} position index")
+        self.moves_base = HEADER.size
+        self.games_base = self.moves_base + self.move_count * MOVE_RECORD.size
+
+    def moves(self, key):
+        index = bisect_records(self.map, self.moves_base, self.move_count, MOVE_RECORD.size, key)
+        found = []
+        while index < self.move_count:
+            record_key, move, count = MOVE_RECORD.unpack_from(self.map, self.moves_base + index * MOVE_RECORD.size)
+            if record_key != key:
+                break
+            found.append((move, count))
+            index += 1
+        found.sort(key=lambda item: -item[1])
+        return found
+
+    def games(self, key, limit=None):
+        index = bisect_records(self.map, self.games_base, self.game_count, GAME_RECORD.size, key)
+        offsets = []
+        while index < self.game_count and (limit is None or len(offsets) < limit):
+            record_key, offset = GAME_RECORD.unpack_from(self.map, self.games_base + index * GAME_RECORD.size)
+            if record_key != key:
+                break
+            offsets.append(offset)
+            index += 1
+        return offsets
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query a memory-mapped position index of a PGN database.")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="bitboard")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build")
+    build.add_argument("pgn")
+    build.add_argument("index")
+    build.add_argument("--plies", type=int, default=None, help="only index the first N plies of each game")
+    probe = commands.add_parser("probe")
+    probe.add_argument("index")
+    probe.add_argument("--fen", default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        stats = build_index(args.pgn, args.index, load_engine(args.engine), args.plies)
+        print(f"indexed {stats['games']} games, {stats['positions']} positions, skipped {stats['skipped']}")
+        return 0
+    index = PositionIndex(args.index)
+    position = from_fen(args.fen) if args.fen else Position()
+    for move, count in index.moves(position.hash):
+        print(f"{move_name(move)} {count}")
+    print(f"{len(index.games(position.hash))} games")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from time import perf_counter
+
+NO_SECTION = nullcontext()
+SMOOTHING = 0.1
+MAX_TRACE_EVENTS = 1 << 20
+
+
+class _Section:
+    def __init__(self, profiler, label):
+        self.profiler = profiler
+        self.label = label
+
+    def __enter__(self):
+        self.started = perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.label, self.started, perf_counter())
+
+
+class Profiler:
+    # Hooks replace functions with timing wrappers only while enabled, so a disabled profiler leaves every call as is.
+    def __init__(self, frames=300):
+        self.enabled = False
+        self.hooks = []
+        self.gauges = []
+        self.frame_times = deque(maxlen=frames)
+        self.frame_start = None
+        self.frame_totals = defaultdict(float)
+        self.frame_counts = defaultdict(int)
+        self.averages = {}
+        self.calls = defaultdict(int)
+        self.trace = None
+        self.profile = None
+        self.origin = perf_counter()
+
+    def hook(self, owner, name, label=None, counter=None):
+        hook = [owner, name, label or name, counter, None]
+        self.hooks.append(hook)
+        if self.enabled:
+            self._install(hook)
+
+    def gauge(self, label, stats):
+        self.gauges.append((label, stats))
+
+    def _install(self, hook):
+        owner, name, label, counter, _ = hook
+        function = owner[name] if isinstance(owner, dict) else getattr(owner, name)
+        hook[4] = function
+        record = self.record
+        counts = self.frame_counts
+
+        def wrapper(*args, **kwargs):
+            started = perf_counter()
+            result = function(*args, **kwargs)
+            record(label, started, perf_counter())
+            if counter is not None:
+                counts[counter] += len(result)
+            return result
+
+        self._set(owner, name, wrapper)
+
+    def _uninstall(self, hook):
+        self._set(hook[0], hook[1], hook[4])
+        hook[4] = None
+
+    def _set(self, owner, name, value):
+        if isinstance(owner, dict):
+            owner[name] = value
+        else:
+            setattr(owner, name, value)
+
+    def enable(self):
+        if not self.enabled:
+            self.enabled = True
+            for hook in self.hooks:
+                self._install(hook)
+
+    def disable(self):
+        if self.enabled and self.trace is None:
+            self.enabled = False
+            for hook in self.hooks:
+                self._uninstall(hook)
+            self.frame_start = None
+
+    def section(self, label):
+        return _Section(self, label) if self.enabled else NO_SECTION
+
+    def record(self, label, started, finished):
+        self.frame_totals[label] += finished - started
+        self.calls[label] += 1
+        if self.trace is not None and len(self.trace) < MAX_TRACE_EVENTS:
+            self.trace.append({"name": label, "ph": "X", "ts": (started - self.origin) * 1e6,
+                               "dur": (finished - started) * 1e6, "pid": os.getpid(), "tid": threading.get_ident()})
+
+    def begin_frame(self):
+        if self.enabled:
+            self.frame_start = perf_counter()
+
+    def end_frame(self):
+        if not self.enabled or self.frame_start is None:
+            return
+        self.record("frame", self.frame_start, perf_counter())
+        self.frame_times.append(self.frame_totals["frame"])
+        for label in set(self.averages) | set(self.frame_totals) | set(self.frame_counts):
+            value = self.frame_totals.get(label, 0.0) if label not in self.frame_counts else self.frame_counts[label]
+            average = self.averages.get(label)
+            self.averages[label] = value if average is None else average + SMOOTHING * (value - average)
+        self.frame_totals.clear()
+        self.frame_counts.clear()
+        self.frame_start = None
+
+    def percentile(self, fraction):
+        if not self.frame_times:
+            return 0.0
+        times = sorted(self.frame_times)
+        return times[min(len(times) - 1, int(fraction * len(times)))]
+
+    def lines(self):
+        lines = ["frame ms  p50 {:.2f}  p95 {:.2f}  p99 {:.2f}".format(
+            *(1000 * self.percentile(fraction) for fraction in (0.5, 0.95, 0.99)))]
+        counters = set(hook[3] for hook in self.hooks if hook[3])
+        sections = sorted(((average, label) for label, average in self.averages.items()
+                           if label != "frame" and label not in counters), reverse=True)
+        for average, label in sections[:6]:
+            lines.append(f"{label}  {1000 * average:.2f} ms")
+        for label in sorted(counters):
+            lines.append(f"{label}/frame  {self.averages.get(label, 0):.1f}")
+        for label, stats in self.gauges:
+            hits, misses = stats()
+            lines.append(f"{label}  {100 * hits / (hits + misses):.1f}% hit" if hits + misses else f"{label}  -")
+        return lines
+
+    def start_profile(self):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def dump_profile(self, path, limit=20):
+        self.profile.disable()
+        self.profile.dump_stats(path)
+        pstats.Stats(self.profile).sort_stats("cumulative").print_stats(limit)
+        self.profile = None
+
+    def start_trace(self):
+        self.enable()
+        self.trace = []
+
+    def dump_trace(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.trace, "displayTimeUnit": "ms"}, f)
+        self.trace = None
@@ -0,0 +1,685 @@
+import importlib
+import random
+from collections import OrderedDict
+
+EMPTY = 0
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = 1, 2, 3, 4, 5, 6
+WHITE, BLACK = 0, 8
+COLORS = {'w': WHITE, 'b': BLACK}
+OPPONENT = {'w': 'b', 'b': 'w'}
+
+PIECE_CODES = {'--': EMPTY}
+for _color, _offset in COLORS.items():
+    for _kind, _letter in enumerate('PNBRQK', 1):
+        PIECE_CODES[_color + _letter] = _offset | _kind
+PIECE_NAMES = ['--'] * 15
+for _name, _code in PIECE_CODES.items():
+    PIECE_NAMES[_code] = _name
+
+INITIAL_BOARD = [
+    ["bR", "bN", "bB", "bQ", "bK", "bB", "bN", "bR"],
+    ["bP", "bP", "bP", "bP", "bP", "bP", "bP", "bP"],
+    ["--", "--", "--", "--", "--", "--", "--", "--"],
+    ["--", "--", "--", "--", "--", "--", "--", "--"],
+    ["--", "--", "--", "--", "--", "--", "--", "--"],
+    ["--", "--", "--", "--", "--", "--", "--", "--"],
+    ["wP", "wP", "wP", "wP", "wP", "wP", "wP", "wP"],
+    ["wR", "wN", "wB", "wQ", "wK", "wB", "wN", "wR"]
+]
+
+
+def _targets(offsets):
+    table = []
+    for sq in range(64):
+        col, row = sq % 8, sq // 8
+        table.append(tuple((row + dy) * 8 + col + dx for dx, dy in offsets
+                           if 0 <= col + dx < 8 and 0 <= row + dy < 8))
+    return tuple(table)
+
+
+def _rays(directions):
+    table = []
+    for sq in range(64):
+        rays = []
+        for dx, dy in directions:
+            ray = []
+            x, y = sq % 8 + dx, sq // 8 + dy
+            while 0 <= x < 8 and 0 <= y < 8:
+                ray.append(y * 8 + x)
+                x += dx
+                y += dy
+            rays.append(tuple(ray))
+        table.append(tuple(rays))
+    return tuple(table)
+
+
+KNIGHT_TARGETS = _targets([(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)])
+KING_TARGETS = _targets([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy])
+ROOK_RAYS = _rays([(0, 1), (0, -1), (1, 0), (-1, 0)])
+BISHOP_RAYS = _rays([(1, 1), (1, -1), (-1, 1), (-1, -1)])
+QUEEN_RAYS = tuple(r + b for r, b in zip(ROOK_RAYS, BISHOP_RAYS))
+PAWN_ATTACKERS = {WHITE: _targets([(-1, 1), (1, 1)]), BLACK: _targets([(-1, -1), (1, -1)])}
+
+
+_zobrist_random = random.Random(0x5EED)
+ZOBRIST_PIECES = tuple(tuple(_zobrist_random.getrandbits(64) for _ in range(64)) for _ in range(15))
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLING = tuple(_zobrist_random.getrandbits(64) for _ in range(16))
+ZOBRIST_EN_PASSANT = tuple(_zobrist_random.getrandbits(64) for _ in range(8))
+
+WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE = 1, 2, 4, 8
+CASTLING_LETTERS = "KQkq"
+# Rights that survive a move touching each square: moving a king or rook, or capturing a rook, clears them.
+CASTLING_MASKS = [15] * 64
+CASTLING_MASKS[60] = 15 & ~(WHITE_KINGSIDE | WHITE_QUEENSIDE)
+CASTLING_MASKS[63] = 15 & ~WHITE_KINGSIDE
+CASTLING_MASKS[56] = 15 & ~WHITE_QUEENSIDE
+CASTLING_MASKS[4] = 15 & ~(BLACK_KINGSIDE | BLACK_QUEENSIDE)
+CASTLING_MASKS[7] = 15 & ~BLACK_KINGSIDE
+CASTLING_MASKS[0] = 15 & ~BLACK_QUEENSIDE
+CASTLING_MASKS = tuple(CASTLING_MASKS)
+# (right, king from, king to, squares that must be empty) for each side.
+CASTLES = {
+    WHITE: ((WHITE_KINGSIDE, 60, 62, (61, 62)), (WHITE_QUEENSIDE, 60, 58, (57, 58, 59))),
+    BLACK: ((BLACK_KINGSIDE, 4, 6, (5, 6)), (BLACK_QUEENSIDE, 4, 2, (1, 2, 3))),
+}
+PROMOTIONS = (QUEEN, ROOK, BISHOP, KNIGHT)
+
+# Material plus piece-square bonuses from White's point of view, laid out as the board is drawn (row 0 is rank 8).
+# Opening and endgame values are packed into one int, endgame * 2**16 + opening, so Position keeps both with one add.
+PIECE_VALUES = {PAWN: 100, KNIGHT: 320, BISHOP: 330, ROOK: 500, QUEEN: 900, KING: 0}
+PIECE_SQUARE_TABLES = {
+    PAWN: [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ],
+    KNIGHT: [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ],
+    BISHOP: [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ],
+    ROOK: [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ],
+    QUEEN: [
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ],
+    KING: [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ],
+}
+KING_ENDGAME_TABLE = [
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10, 0, 0, -10, -20, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -30, 0, 0, 0, 0, -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50,
+]
+
+
+def pack_score(opening, endgame):
+    return (endgame << 16) + opening
+
+
+def unpack_score(score):
+    opening = ((score + 0x8000) & 0xFFFF) - 0x8000
+    return opening, (score - opening) >> 16
+
+
+def _piece_square(kind, sq):
+    opening = PIECE_VALUES[kind] + PIECE_SQUARE_TABLES[kind][sq]
+    endgame = PIECE_VALUES[kind] + (KING_ENDGAME_TABLE[sq] if kind == KING else PIECE_SQUARE_TABLES[kind][sq])
+    return pack_score(opening, endgame)
+
+
+PIECE_SQUARE = [(0,) * 64] * 15
+for _kind in PIECE_VALUES:
+    PIECE_SQUARE[WHITE | _kind] = tuple(_piece_square(_kind, sq) for sq in range(64))
+    PIECE_SQUARE[BLACK | _kind] = tuple(-_piece_square(_kind, sq ^ 56) for sq in range(64))
+PIECE_SQUARE = tuple(PIECE_SQUARE)
+
+ENGINES = {'mailbox': 'rules', 'bitboard': 'bitboard'}
+
+
+def load_engine(name):
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine {name!r}, expected one of {', '.join(ENGINES)}")
+    return importlib.import_module(ENGINES[name])
+
+
+def make_move_code(start, end, promotion=EMPTY):
+    return start | (end << 6) | (promotion << 12)
+
+
+def move_to_coords(move):
+    start, end = move & 63, (move >> 6) & 63
+    return (start % 8, start // 8), (end % 8, end // 8)
+
+
+def coords_to_square(pos):
+    return pos[1] * 8 + pos[0]
+
+
+class Position:
+    def __init__(self, board=None, turn='w', castling=None, ep_square=None, halfmove_clock=0, fullmove_number=1):
+        self.squares = bytearray(64)
+        self.kings = {WHITE: None, BLACK: None}
+        self.bitboards = [0] * 15
+        self.occupancy = {WHITE: 0, BLACK: 0}
+        self.turn = turn
+        self.stack = []
+        self.hash = ZOBRIST_BLACK_TO_MOVE if turn == 'b' else 0
+        self.score = 0
+        for row, line in enumerate(board or INITIAL_BOARD):
+            for col, name in enumerate(line):
+                self.put(row * 8 + col, PIECE_CODES[name])
+        # Rights whose king or rook is not on its home square are dropped.
+        self.castling = infer_castling(self.squares) & (15 if castling is None else castling)
+        self.hash ^= ZOBRIST_CASTLING[self.castling]
+        self.ep_square = None
+        if ep_square is not None and _en_passant_possible(self.squares, ep_square, COLORS[turn]):
+            self.ep_square = ep_square
+            self.hash ^= ZOBRIST_EN_PASSANT[ep_square & 7]
+        self.halfmove_clock = halfmove_clock
+        self.fullmove_number = fullmove_number
+
+    def put(self, sq, piece):
+        self.squares[sq] = piece
+        if piece:
+            self.bitboards[piece] |= 1 << sq
+            self.occupancy[piece & 8] |= 1 << sq
+            self.hash ^= ZOBRIST_PIECES[piece][sq]
+            self.score += PIECE_SQUARE[piece][sq]
+        if piece & 7 == KING:
+            self.kings[piece & 8] = sq
+
+    def copy(self):
+        other = Position.__new__(Position)
+        other.squares = bytearray(self.squares)
+        other.kings = dict(self.kings)
+        other.bitboards = list(self.bitboards)
+        other.occupancy = dict(self.occupancy)
+        other.turn = self.turn
+        other.stack = list(self.stack)
+        other.hash = self.hash
+        other.score = self.score
+        other.castling = self.castling
+        other.ep_square = self.ep_square
+        other.halfmove_clock = self.halfmove_clock
+        other.fullmove_number = self.fullmove_number
+        return other
+
+    def make_move(self, move):
+        squares = self.squares
+        start, end, promotion = move & 63, (move >> 6) & 63, move >> 12
+        piece = squares[start]
+        captured = squares[end]
+        color = piece & 8
+        kind = piece & 7
+        moved = color | promotion if promotion else piece
+        squares[start] = EMPTY
+        squares[end] = moved
+        start_bit, end_bit = 1 << start, 1 << end
+        bitboards = self.bitboards
+        occupancy = self.occupancy
+        bitboards[piece] ^= start_bit
+        bitboards[moved] |= end_bit
+        occupancy[color] ^= start_bit | end_bit
+        key, score, castling, ep_square = self.hash, self.score, self.castling, self.ep_square
+        self.stack.append((move, piece, captured, key, score, castling, ep_square, self.halfmove_clock))
+        key ^= ZOBRIST_PIECES[piece][start] ^ ZOBRIST_PIECES[moved][end] ^ ZOBRIST_BLACK_TO_MOVE
+        score += PIECE_SQUARE[moved][end] - PIECE_SQUARE[piece][start]
+        if captured:
+            bitboards[captured] ^= end_bit
+            occupancy[captured & 8] ^= end_bit
+            key ^= ZOBRIST_PIECES[captured][end]
+            score -= PIECE_SQUARE[captured][end]
+            self.halfmove_clock = 0
+        elif kind == PAWN:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if ep_square is not None:
+            key ^= ZOBRIST_EN_PASSANT[ep_square & 7]
+            self.ep_square = None
+            if end == ep_square and kind == PAWN:
+                victim_sq = end + 8 if color == WHITE else end - 8
+                victim = squares[victim_sq]
+                squares[victim_sq] = EMPTY
+                bitboards[victim] ^= 1 << victim_sq
+                occupancy[victim & 8] ^= 1 << victim_sq
+                key ^= ZOBRIST_PIECES[victim][victim_sq]
+                score -= PIECE_SQUARE[victim][victim_sq]
+        if kind == PAWN:
+            if end - start == 16 or start - end == 16:
+                middle = (start + end) >> 1
+                if _en_passant_possible(squares, middle, color ^ 8):
+                    self.ep_square = middle
+                    key ^= ZOBRIST_EN_PASSANT[middle & 7]
+        elif kind == KING:
+            self.kings[color] = end
+            if end - start == 2 or start - end == 2:
+                rook_from, rook_to = (start + 3, start + 1) if end > start else (start - 4, start - 1)
+                rook = color | ROOK
+                squares[rook_from] = EMPTY
+                squares[rook_to] = rook
+                bitboards[rook] ^= (1 << rook_from) | (1 << rook_to)
+                occupancy[color] ^= (1 << rook_from) | (1 << rook_to)
+                key ^= ZOBRIST_PIECES[rook][rook_from] ^ ZOBRIST_PIECES[rook][rook_to]
+                score += PIECE_SQUARE[rook][rook_to] - PIECE_SQUARE[rook][rook_from]
+        if castling:
+            self.castling = castling & CASTLING_MASKS[start] & CASTLING_MASKS[end]
+            key ^= ZOBRIST_CASTLING[castling] ^ ZOBRIST_CASTLING[self.castling]
+        self.hash = key
+        self.score = score
+        if color == BLACK:
+            self.fullmove_number += 1
+        self.turn = OPPONENT[self.turn]
+
+    def unmake_move(self):
+        move, piece, captured, self.hash, self.score, self.castling, ep_square, self.halfmove_clock = self.stack.pop()
+        self.ep_square = ep_square
+        start, end = move & 63, (move >> 6) & 63
+        squares = self.squares
+        color = piece & 8
+        kind = piece & 7
+        start_bit, end_bit = 1 << start, 1 << end
+        bitboards = self.bitboards
+        occupancy = self.occupancy
+        bitboards[squares[end]] ^= end_bit
+        bitboards[piece] |= start_bit
+        occupancy[color] ^= start_bit | end_bit
+        if captured:
+            bitboards[captured] |= end_bit
+            occupancy[captured & 8] ^= end_bit
+        squares[start] = piece
+        squares[end] = captured
+        if kind == PAWN:
+            if end == ep_square:
+                victim_sq = end + 8 if color == WHITE else end - 8
+                victim = (color ^ 8) | PAWN
+                squares[victim_sq] = victim
+                bitboards[victim] |= 1 << victim_sq
+                occupancy[color ^ 8] |= 1 << victim_sq
+        elif kind == KING:
+            self.kings[color] = start
+            if end - start == 2 or start - end == 2:
+                rook_from, rook_to = (start + 3, start + 1) if end > start else (start - 4, start - 1)
+                rook = color | ROOK
+                squares[rook_to] = EMPTY
+                squares[rook_from] = rook
+                bitboards[rook] ^= (1 << rook_from) | (1 << rook_to)
+                occupancy[color] ^= (1 << rook_from) | (1 << rook_to)
+        if color == BLACK:
+            self.fullmove_number -= 1
+        self.turn = OPPONENT[self.turn]
+        return move
+
+    def repetitions(self):
+        # How many times the current position has occurred since the last capture or pawn move, counting this one.
+        stack = self.stack
+        count = 1
+        for i in range(len(stack) - 2, max(len(stack) - self.halfmove_clock, 0) - 1, -2):
+            if stack[i][3] == self.hash:
+                count += 1
+        return count
+
+    def is_draw(self):
+        return self.halfmove_clock >= 100 or self.repetitions() >= 3
+
+
+def infer_castling(squares):
+    castling = 0
+    for color in (WHITE, BLACK):
+        for right, king_from, king_to, _ in CASTLES[color]:
+            rook_from = king_from + 3 if king_to > king_from else king_from - 4
+            if squares[king_from] == color | KING and squares[rook_from] == color | ROOK:
+                castling |= right
+    return castling
+
+
+def _en_passant_possible(squares, sq, color):
+    # Only record an en-passant square when a pawn of `color` could capture onto it, so hashes of equal positions match.
+    victim_sq = sq + 8 if color == WHITE else sq - 8
+    return any(squares[source] == color | PAWN for source in PAWN_ATTACKERS[color][sq]) and \
+        0 <= victim_sq < 64 and squares[victim_sq] == (color ^ 8) | PAWN
+
+
+def compute_hash(position):
+    key = ZOBRIST_BLACK_TO_MOVE if position.turn == 'b' else 0
+    key ^= ZOBRIST_CASTLING[position.castling]
+    if position.ep_square is not None:
+        key ^= ZOBRIST_EN_PASSANT[position.ep_square & 7]
+    for sq, piece in enumerate(position.squares):
+        if piece:
+            key ^= ZOBRIST_PIECES[piece][sq]
+    return key
+
+
+def compute_score(position):
+    return sum(PIECE_SQUARE[piece][sq] for sq, piece in enumerate(position.squares) if piece)
+
+
+class LegalMoveCache:
+    def __init__(self, engine, maxsize=4096):
+        self.engine = engine
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, position):
+        entry = self.entries.get(position.hash)
+        if entry is not None:
+            self.entries.move_to_end(position.hash)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = (self.engine.get_all_legal_moves(position, position.turn),
+                 self.engine.is_in_check(position, position.turn))
+        self.entries[position.hash] = entry
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
+
+    def legal_moves(self, position):
+        return self.lookup(position)[0]
+
+    def in_check(self, position):
+        return self.lookup(position)[1]
+
+    def clear(self):
+        self.entries.clear()
+
+
+def from_board(board, turn='w'):
+    return Position(board, turn)
+
+
+def to_board(position):
+    names = [PIECE_NAMES[piece] for piece in position.squares]
+    return [names[row * 8:row * 8 + 8] for row in range(8)]
+
+
+def from_fen(fen):
+    fields = fen.split()
+    board = []
+    for line in fields[0].split('/'):
+        row = []
+        for char in line:
+            if char.isdigit():
+                row.extend(['--'] * int(char))
+            else:
+                row.append(('w' if char.isupper() else 'b') + char.upper())
+        board.append(row)
+    fields += ['w', '-', '-', '0', '1'][len(fields) - 1:]
+    castling = sum(1 << CASTLING_LETTERS.index(char) for char in fields[2] if char in CASTLING_LETTERS)
+    ep_square = coords_to_square(("abcdefgh".index(fields[3][0]), 8 - int(fields[3][1]))) if fields[3] != '-' else None
+    return Position(board, fields[1], castling, ep_square,
+                    int(fields[4]), int(fields[5]))
+
+
+def to_fen(position):
+    rows = []
+    for row in to_board(position):
+        line = ''
+        empty = 0
+        for name in row:
+            if name == '--':
+                empty += 1
+                continue
+            if empty:
+                line += str(empty)
+                empty = 0
+            line += name[1] if name[0] == 'w' else name[1].lower()
+        rows.append(line + (str(empty) if empty else ''))
+    castling = ''.join(char for i, char in enumerate(CASTLING_LETTERS) if position.castling & (1 << i)) or '-'
+    ep_square = position.ep_square
+    ep = f"{'abcdefgh'[ep_square % 8]}{8 - ep_square // 8}" if ep_square is not None else '-'
+    return f"{'/'.join(rows)} {position.turn} {castling} {ep} {position.halfmove_clock} {position.fullmove_number}"
+
+
+def piece_at(position, col, row):
+    return PIECE_NAMES[position.squares[row * 8 + col]]
+
+
+def get_pseudo_legal_moves(position, player):
+    color = COLORS[player]
+    squares = position.squares
+    moves = []
+    for sq in range(64):
+        piece = squares[sq]
+        if not piece or piece & 8 != color:
+            continue
+        kind = piece & 7
+        if kind == PAWN:
+            get_pawn_moves(squares, sq, color, moves)
+        elif kind == KNIGHT:
+            get_step_moves(squares, sq, color, KNIGHT_TARGETS[sq], moves)
+        elif kind == BISHOP:
+            get_slider_moves(squares, sq, color, BISHOP_RAYS[sq], moves)
+        elif kind == ROOK:
+            get_slider_moves(squares, sq, color, ROOK_RAYS[sq], moves)
+        elif kind == QUEEN:
+            get_slider_moves(squares, sq, color, QUEEN_RAYS[sq], moves)
+        elif kind == KING:
+            get_step_moves(squares, sq, color, KING_TARGETS[sq], moves)
+    ep_square = position.ep_square
+    if ep_square is not None:
+        for source in PAWN_ATTACKERS[color][ep_square]:
+            if squares[source] == color | PAWN:
+                moves.append(source | (ep_square << 6))
+    if position.castling:
+        get_castling_moves(position, color, moves)
+    return moves
+
+
+def get_pawn_moves(squares, sq, color, moves):
+    col, row = sq % 8, sq // 8
+    direction = -8 if color == WHITE else 8
+    start_row = 6 if color == WHITE else 1
+    last_row = 0 if color == WHITE else 7
+    ahead = sq + direction
+    if not 0 <= ahead < 64:
+        return
+    promotes = ahead // 8 == last_row
+    if squares[ahead] == EMPTY:
+        if promotes:
+            moves.extend(sq | (ahead << 6) | (kind << 12) for kind in PROMOTIONS)
+        else:
+            moves.append(sq | (ahead << 6))
+            if row == start_row and squares[ahead + direction] == EMPTY:
+                moves.append(sq | ((ahead + direction) << 6))
+    for capture, ok in ((ahead - 1, col > 0), (ahead + 1, col < 7)):
+        if ok:
+            target = squares[capture]
+            if target and target & 8 != color:
+                if promotes:
+                    moves.extend(sq | (capture << 6) | (kind << 12) for kind in PROMOTIONS)
+                else:
+                    moves.append(sq | (capture << 6))
+
+
+def get_castling_moves(position, color, moves):
+    # Pseudo-legal: rights and empty squares only; the legal filter checks the squares the king crosses.
+    squares = position.squares
+    for right, king_from, king_to, between in CASTLES[color]:
+        if position.castling & right and all(squares[sq] == EMPTY for sq in between):
+            moves.append(king_from | (king_to << 6))
+
+
+def get_step_moves(squares, sq, color, targets, moves):
+    for target_sq in targets:
+        target = squares[target_sq]
+        if not target or target & 8 != color:
+            moves.append(sq | (target_sq << 6))
+
+
+def get_slider_moves(squares, sq, color, rays, moves):
+    for ray in rays:
+        for target_sq in ray:
+            target = squares[target_sq]
+            if not target:
+                moves.append(sq | (target_sq << 6))
+                continue
+            if target & 8 != color:
+                moves.append(sq | (target_sq << 6))
+            break
+
+
+def find_king_position(position, player):
+    return position.kings[COLORS[player]]
+
+
+def is_square_attacked(squares, sq, by_color):
+    for source in KNIGHT_TARGETS[sq]:
+        if squares[source] == by_color | KNIGHT:
+            return True
+    for source in PAWN_ATTACKERS[by_color][sq]:
+        if squares[source] == by_color | PAWN:
+            return True
+    for source in KING_TARGETS[sq]:
+        if squares[source] == by_color | KING:
+            return True
+    for rays, slider in ((ROOK_RAYS, ROOK), (BISHOP_RAYS, BISHOP)):
+        for ray in rays[sq]:
+            for source in ray:
+                piece = squares[source]
+                if piece:
+                    if piece == by_color | slider or piece == by_color | QUEEN:
+                        return True
+                    break
+    return False
+
+
+def is_in_check(position, player):
+    king_sq = find_king_position(position, player)
+    if king_sq is None:
+        return False
+    return is_square_attacked(position.squares, king_sq, COLORS[OPPONENT[player]])
+
+
+def get_pins_and_checks(squares, king_sq, color):
+    enemy = color ^ 8
+    pins = {}
+    checkers = []
+    evasions = set()
+    for source in KNIGHT_TARGETS[king_sq]:
+        if squares[source] == enemy | KNIGHT:
+            checkers.append(source)
+            evasions.add(source)
+    for source in PAWN_ATTACKERS[enemy][king_sq]:
+        if squares[source] == enemy | PAWN:
+            checkers.append(source)
+            evasions.add(source)
+    for rays, slider in ((ROOK_RAYS, ROOK), (BISHOP_RAYS, BISHOP)):
+        for ray in rays[king_sq]:
+            blocker = None
+            for i, source in enumerate(ray):
+                piece = squares[source]
+                if not piece:
+                    continue
+                if piece & 8 == color:
+                    if blocker is not None:
+                        break
+                    blocker = source
+                    continue
+                if piece == enemy | slider or piece == enemy | QUEEN:
+                    if blocker is None:
+                        checkers.append(source)
+                        evasions.update(ray[:i + 1])
+                    else:
+                        pins[blocker] = frozenset(ray[:i + 1])
+                break
+    return pins, checkers, evasions
+
+
+def get_all_legal_moves(position, player):
+    color = COLORS[player]
+    king_sq = position.kings[color]
+    pseudo_moves = get_pseudo_legal_moves(position, player)
+    if king_sq is None:
+        return pseudo_moves
+    pins, checkers, evasions = get_pins_and_checks(position.squares, king_sq, color)
+    ep_square = position.ep_square
+    if checkers or pins or ep_square is not None:
+        legal_moves = []
+        king_moves = []
+        for move in pseudo_moves:
+            start, end = move & 63, (move >> 6) & 63
+            if start == king_sq:
+                king_moves.append(move)
+            elif end == ep_square and position.squares[start] & 7 == PAWN:
+                # The captured pawn leaves a square other than the target, so check the result directly.
+                position.make_move(move)
+                if not is_square_attacked(position.squares, king_sq, color ^ 8):
+                    legal_moves.append(move)
+                position.unmake_move()
+            elif len(checkers) > 1:
+                continue
+            elif start in pins:
+                if not checkers and end in pins[start]:
+                    legal_moves.append(move)
+            elif not checkers or end in evasions:
+                legal_moves.append(move)
+    else:
+        # Nothing pinned and no check: every non-king move is legal.
+        legal_moves = [move for move in pseudo_moves if move & 63 != king_sq]
+        king_moves = [move for move in pseudo_moves if move & 63 == king_sq]
+    # Lift the king so sliders attack through its current square.
+    squares = position.squares
+    squares[king_sq] = EMPTY
+    for move in king_moves:
+        end = (move >> 6) & 63
+        if end - king_sq == 2 or king_sq - end == 2:
+            if checkers or is_square_attacked(squares, (king_sq + end) >> 1, color ^ 8):
+                continue
+        if not is_square_attacked(squares, end, color ^ 8):
+            legal_moves.append(move)
+    squares[king_sq] = color | KING
+    return legal_moves
@@ -0,0 +1,279 @@
+import time
+from collections import namedtuple
+
+from evaluation import Evaluator
+from rules import EMPTY, PIECE_VALUES as MATERIAL
+
+MATE = 100000
+INFINITY = MATE + 1
+PIECE_VALUES = {EMPTY: 0, **MATERIAL}
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+SearchResult = namedtuple("SearchResult", "move score depth nodes elapsed pv")
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def allocate_time(remaining, moves_to_go=30):
+    return max(0.05, min(remaining / moves_to_go, remaining / 2))
+
+
+def _to_tt_score(score, ply):
+    if score > MATE - 1000:
+        return score + ply
+    if score < -MATE + 1000:
+        return score - ply
+    return score
+
+
+def _from_tt_score(score, ply):
+    if score > MATE - 1000:
+        return score - ply
+    if score < -MATE + 1000:
+        return score + ply
+    return score
+
+
+class TranspositionTable:
+    def __init__(self, size=1 << 18):
+        self.size = size
+        self.slots = [None] * size
+        self.generation = 0
+
+    def new_search(self):
+        self.generation = (self.generation + 1) & 0xFF
+
+    def probe(self, key):
+        entry = self.slots[key % self.size]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def store(self, key, depth, score, flag, move):
+        index = key % self.size
+        entry = self.slots[index]
+        # Keep deeper results from the current search; anything older or shallower is replaced.
+        if entry is None or entry[0] == key or entry[5] != self.generation or depth >= entry[1]:
+            self.slots[index] = (key, depth, score, flag, move, self.generation)
+
+    def clear(self):
+        self.slots = [None] * self.size
+
+
+class Searcher:
+    def __init__(self, engine, tt_size=1 << 18):
+        self.engine = engine
+        self.tt = TranspositionTable(tt_size)
+        self.evaluator = Evaluator()
+        self.nodes = 0
+        self.deadline = None
+        self.should_stop = None
+        self.root_ply = 0
+        self.killers = []
+        self.history = [[0] * 64 for _ in range(15)]
+
+    def start_search(self, position, time_limit, max_depth, should_stop):
+        started = time.perf_counter()
+        self.deadline = started + time_limit if time_limit else None
+        self.should_stop = should_stop
+        self.nodes = 0
+        self.killers = [[0, 0] for _ in range(max_depth + 64)]
+        self.history = [[value // 8 for value in row] for row in self.history]
+        self.tt.new_search()
+        self.root_ply = len(position.stack)
+        return started
+
+    def search(self, position, time_limit=None, max_depth=64, on_info=None, should_stop=None):
+        started = self.start_search(position, time_limit, max_depth, should_stop)
+        best = None
+        for depth in range(1, max_depth + 1):
+            try:
+                timed = depth > 1 and bool(self.deadline or should_stop)
+                score = self.negamax(position, depth, -INFINITY, INFINITY, 0, timed)
+            except SearchTimeout:
+                while len(position.stack) > self.root_ply:
+                    position.unmake_move()
+                break
+            elapsed = time.perf_counter() - started
+            pv = self.principal_variation(position, depth)
+            best = SearchResult(pv[0] if pv else None, score, depth, self.nodes, elapsed, pv)
+            if on_info:
+                on_info(best)
+            if not pv or abs(score) > MATE - 1000:
+                break
+            if time_limit and elapsed > time_limit / 2:
+                break
+        if best is None:
+            moves = self.engine.get_all_legal_moves(position, position.turn)
+            best = SearchResult(moves[0] if moves else None, 0, 0, self.nodes,
+                                time.perf_counter() - started, moves[:1])
+        return best
+
+    def search_lines(self, position, lines=3, time_limit=None, max_depth=64, on_info=None, should_stop=None):
+        # Multi-PV: every root move is searched with the score of the current N-th best line as its lower bound, so the
+        # top lines get exact scores and the rest only have to be refuted.
+        started = self.start_search(position, time_limit, max_depth, should_stop)
+        moves = self.engine.get_all_legal_moves(position, position.turn)
+        best = []
+        for depth in range(1, max_depth + 1):
+            scored = []
+            try:
+                timed = depth > 1 and bool(self.deadline or should_stop)
+                for move in moves:
+                    bound = scored[lines - 1][0] if len(scored) >= lines else -INFINITY
+                    position.make_move(move)
+                    score = -self.negamax(position, depth - 1, -INFINITY, -bound, 1, timed)
+                    position.unmake_move()
+                    scored.append((score, move))
+                    scored.sort(key=lambda item: -item[0])
+            except SearchTimeout:
+                while len(position.stack) > self.root_ply:
+                    position.unmake_move()
+                break
+            moves = [move for _, move in scored]
+            elapsed = time.perf_counter() - started
+            best = []
+            for score, move in scored[:lines]:
+                position.make_move(move)
+                pv = [move] + self.principal_variation(position, depth - 1)
+                position.unmake_move()
+                best.append(SearchResult(move, score, depth, self.nodes, elapsed, pv))
+            if on_info:
+                on_info(best)
+            if not best or all(abs(line.score) > MATE - 1000 for line in best):
+                break
+            if time_limit and elapsed > time_limit / 2:
+                break
+        return best
+
+    def check_time(self):
+        if self.deadline and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+        if self.should_stop and self.should_stop():
+            raise SearchTimeout()
+
+    def order_moves(self, position, moves, tt_move, ply):
+        squares = position.squares
+        killers = self.killers[ply]
+        history = self.history
+        scored = []
+        for move in moves:
+            if move == tt_move:
+                score = 1 << 30
+            else:
+                start, end = move & 63, (move >> 6) & 63
+                captured = squares[end]
+                if captured or move >> 12:
+                    score = (1 << 20) + 10 * PIECE_VALUES[captured & 7] - PIECE_VALUES[squares[start] & 7] \
+                        + PIECE_VALUES[move >> 12]
+                elif move == killers[0]:
+                    score = (1 << 19) + 1
+                elif move == killers[1]:
+                    score = 1 << 19
+                else:
+                    score = history[squares[start]][end]
+            scored.append((score, move))
+        scored.sort(reverse=True)
+        return [move for _, move in scored]
+
+    def negamax(self, position, depth, alpha, beta, ply, timed):
+        self.nodes += 1
+        if timed and not self.nodes & 1023:
+            self.check_time()
+
+        # Inside the tree a single repetition is scored as the draw it can be turned into.
+        if ply and (position.halfmove_clock >= 100 or position.repetitions() > 1):
+            return 0
+
+        key = position.hash
+        entry = self.tt.probe(key)
+        tt_move = 0
+        if entry is not None:
+            tt_move = entry[4]
+            if ply and entry[1] >= depth:
+                score = _from_tt_score(entry[2], ply)
+                flag = entry[3]
+                if flag == EXACT or (flag == LOWER and score >= beta) or (flag == UPPER and score <= alpha):
+                    return score
+
+        if depth <= 0:
+            return self.quiescence(position, alpha, beta, ply, timed)
+
+        moves = self.engine.get_all_legal_moves(position, position.turn)
+        if not moves:
+            if self.engine.is_in_check(position, position.turn):
+                return -MATE + ply
+            return 0
+
+        original_alpha = alpha
+        best_score = -INFINITY
+        best_move = 0
+        squares = position.squares
+        for move in self.order_moves(position, moves, tt_move, ply):
+            quiet = not squares[(move >> 6) & 63] and not move >> 12
+            position.make_move(move)
+            score = -self.negamax(position, depth - 1, -beta, -alpha, ply + 1, timed)
+            position.unmake_move()
+            if score > best_score:
+                best_score = score
+                best_move = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if quiet:
+                    killers = self.killers[ply]
+                    if killers[0] != move:
+                        killers[1] = killers[0]
+                        killers[0] = move
+                    self.history[squares[move & 63]][(move >> 6) & 63] += depth * depth
+                break
+
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.tt.store(key, depth, _to_tt_score(best_score, ply), flag, best_move)
+        return best_score
+
+    def quiescence(self, position, alpha, beta, ply, timed):
+        stand_pat = self.evaluator.evaluate(position)
+        if stand_pat >= beta:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+        squares = position.squares
+        moves = [move for move in self.engine.get_all_legal_moves(position, position.turn)
+                 if squares[(move >> 6) & 63] or move >> 12]
+        for move in self.order_moves(position, moves, 0, ply):
+            self.nodes += 1
+            if timed and not self.nodes & 1023:
+                self.check_time()
+            position.make_move(move)
+            score = -self.quiescence(position, -beta, -alpha, ply + 1, timed)
+            position.unmake_move()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def principal_variation(self, position, depth):
+        pv = []
+        seen = set()
+        for _ in range(depth):
+            entry = self.tt.probe(position.hash)
+            if entry is None or not entry[4] or position.hash in seen:
+                break
+            if entry[4] not in self.engine.get_all_legal_moves(position, position.turn):
+                break
+            seen.add(position.hash)
+            pv.append(entry[4])
+            position.make_move(entry[4])
+        for _ in pv:
+            position.unmake_move()
+        return pv
@@ -0,0 +1,87 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from game import Game
+from rules import ENGINES, load_engine
+from search import Searcher
+
+
+def make_player(spec, engine, rng):
+    kind, _, arg = spec.partition(":")
+    if kind == "random":
+        return lambda game: rng.choice(game.legal_moves())
+    if kind == "engine":
+        searcher = Searcher(engine)
+        depth = int(arg or 2)
+        return lambda game: searcher.search(game.position, max_depth=depth).move
+    raise ValueError(f"Unknown player {spec!r}, expected 'random' or 'engine:DEPTH'")
+
+
+def play_game(task):
+    index, white, black, engine_name, max_plies, seed = task
+    engine = load_engine(engine_name)
+    rng = random.Random(seed)
+    players = {'w': make_player(white, engine, rng), 'b': make_player(black, engine, rng)}
+    game = Game(engine)
+    move_times = []
+    started = time.perf_counter()
+    outcome = game.outcome()
+    while outcome is None and len(move_times) < max_plies:
+        move_started = time.perf_counter()
+        move = players[game.position.turn](game)
+        move_times.append(round(time.perf_counter() - move_started, 6))
+        game.play(move)
+        outcome = game.outcome()
+    # A game cut off at the ply limit has no result; "*" is PGN's marker for an unfinished game.
+    result, reason = outcome or ("*", "max plies")
+    return {
+        "game": index,
+        "white": white,
+        "black": black,
+        "result": result,
+        "reason": reason,
+        "plies": len(move_times),
+        "seconds": round(time.perf_counter() - started, 6),
+        "move_times": move_times,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play batches of headless games across all cores.")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--white", default="random", help="'random' or 'engine:DEPTH'")
+    parser.add_argument("--black", default="random", help="'random' or 'engine:DEPTH'")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="bitboard")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--max-plies", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="selfplay.jsonl")
+    args = parser.parse_args(argv)
+
+    tasks = [(i, args.white, args.black, args.engine, args.max_plies, args.seed + i) for i in range(args.games)]
+    scores = {"1-0": 0, "0-1": 0, "1/2-1/2": 0, "*": 0}
+    plies = 0
+    started = time.perf_counter()
+    with open(args.output, "w") as out, multiprocessing.Pool(args.workers) as pool:
+        for record in pool.imap_unordered(play_game, tasks):
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            scores[record["result"]] += 1
+            plies += record["plies"]
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.games} games in {elapsed:.2f}s with {args.workers} workers: "
+          f"{args.games / elapsed:.2f} games/s, {args.games / elapsed / args.workers:.2f} games/s per worker, "
+          f"{plies / elapsed:.0f} plies/s")
+    print(f"white {scores['1-0']}  black {scores['0-1']}  draws {scores['1/2-1/2']}  "
+          f"unfinished {scores['*']}  -> {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
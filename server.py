@@ -0,0 +1,329 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import time
+from collections import deque, namedtuple
+
+from game import Game
+from rules import ENGINES, Position, load_engine
+
+JOIN, MOVE, RESIGN, STARTED, MOVED, REJECTED, ENDED = range(1, 8)
+RESULTS = ("1-0", "0-1", "1/2-1/2")
+REASONS = ("checkmate", "stalemate", "fifty-move rule", "threefold repetition", "time", "resignation", "disconnect")
+
+Join = namedtuple("Join", "time_control")
+PlayMove = namedtuple("PlayMove", "move")
+Resign = namedtuple("Resign", "")
+Started = namedtuple("Started", "game color white_ms black_ms")
+Moved = namedtuple("Moved", "move white_ms black_ms")
+Rejected = namedtuple("Rejected", "move")
+Ended = namedtuple("Ended", "result reason")
+
+# Every message is a type byte followed by a fixed layout; a move is the engine's own 16-bit from/to/promotion code.
+MESSAGES = {
+    JOIN: (struct.Struct("<BH"), Join),
+    MOVE: (struct.Struct("<BH"), PlayMove),
+    RESIGN: (struct.Struct("<B"), Resign),
+    STARTED: (struct.Struct("<BIBII"), Started),
+    MOVED: (struct.Struct("<BHII"), Moved),
+    REJECTED: (struct.Struct("<BH"), Rejected),
+    ENDED: (struct.Struct("<BBB"), Ended),
+}
+MESSAGE_TYPES = {message: kind for kind, (_, message) in MESSAGES.items()}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode(message):
+    kind = MESSAGE_TYPES[type(message)]
+    return MESSAGES[kind][0].pack(kind, *message)
+
+
+async def read_message(reader):
+    header = await reader.readexactly(1)
+    if header[0] not in MESSAGES:
+        raise ProtocolError(f"Unknown message type {header[0]}")
+    layout, message = MESSAGES[header[0]]
+    return message(*layout.unpack(header + await reader.readexactly(layout.size - 1))[1:])
+
+
+class Player:
+    def __init__(self, writer):
+        self.writer = writer
+        self.game = None
+        self.color = None
+
+    def send(self, message):
+        self.writer.write(encode(message))
+
+
+class ServerGame:
+    def __init__(self, server, game_id, time_control, white, black):
+        self.server = server
+        self.id = game_id
+        self.game = Game(server.engine, cache_size=server.cache_size)
+        self.players = {'w': white, 'b': black}
+        self.clocks = {'w': float(time_control), 'b': float(time_control)}
+        self.loop = asyncio.get_running_loop()
+        self.turn_started = None
+        self.flag = None
+        self.over = False
+        for color, player in self.players.items():
+            player.game, player.color = self, color
+
+    def clock_ms(self):
+        return max(0, round(self.clocks['w'] * 1000)), max(0, round(self.clocks['b'] * 1000))
+
+    def start(self):
+        for color, player in self.players.items():
+            player.send(Started(self.id, 0 if color == 'w' else 1, *self.clock_ms()))
+        self.start_clock()
+
+    def start_clock(self):
+        self.turn_started = self.loop.time()
+        self.flag = self.loop.call_later(self.clocks[self.game.position.turn], self.flag_fall)
+
+    def flag_fall(self):
+        turn = self.game.position.turn
+        self.clocks[turn] = 0
+        self.finish("0-1" if turn == 'w' else "1-0", "time")
+
+    def play(self, player, move):
+        if self.over or player.color != self.game.position.turn or move not in self.game.legal_moves():
+            player.send(Rejected(move))
+            return
+        self.flag.cancel()
+        self.clocks[player.color] -= self.loop.time() - self.turn_started
+        if self.clocks[player.color] <= 0:
+            self.flag_fall()
+            return
+        self.game.play(move)
+        moved = encode(Moved(move, *self.clock_ms()))
+        for other in self.players.values():
+            other.writer.write(moved)
+        outcome = self.game.outcome()
+        if outcome is not None:
+            self.finish(*outcome)
+        else:
+            self.start_clock()
+
+    def resign(self, player, reason="resignation"):
+        self.finish("0-1" if player.color == 'w' else "1-0", reason)
+
+    def finish(self, result, reason):
+        if self.over:
+            return
+        self.over = True
+        if self.flag is not None:
+            self.flag.cancel()
+        ended = encode(Ended(RESULTS.index(result), REASONS.index(reason)))
+        for player in self.players.values():
+            player.writer.write(ended)
+            player.game = None
+        self.server.finish(self)
+
+
+class GameServer:
+    def __init__(self, engine, cache_size=64):
+        self.engine = engine
+        self.cache_size = cache_size
+        self.waiting = {}
+        self.games = {}
+        self.next_id = 1
+        self.finished = 0
+        self.moves = 0
+
+    def join(self, player, time_control):
+        if player.game is not None:
+            return
+        opponent = self.waiting.pop(time_control, None)
+        if opponent is None or opponent is player:
+            self.waiting[time_control] = player
+            return
+        game = ServerGame(self, self.next_id, time_control, opponent, player)
+        self.games[game.id] = game
+        self.next_id += 1
+        game.start()
+
+    def leave(self, player):
+        for time_control, waiting in list(self.waiting.items()):
+            if waiting is player:
+                del self.waiting[time_control]
+        if player.game is not None:
+            player.game.resign(player, "disconnect")
+
+    def finish(self, game):
+        del self.games[game.id]
+        self.finished += 1
+        self.moves += len(game.game.log.records)
+
+    async def handle(self, reader, writer):
+        player = Player(writer)
+        try:
+            while True:
+                message = await read_message(reader)
+                if isinstance(message, Join):
+                    self.join(player, message.time_control)
+                elif isinstance(message, PlayMove):
+                    if player.game is None:
+                        player.send(Rejected(message.move))
+                    else:
+                        player.game.play(player, message.move)
+                elif isinstance(message, Resign):
+                    if player.game is not None:
+                        player.game.resign(player)
+                else:
+                    raise ProtocolError(f"Unexpected {type(message).__name__} from a client")
+        except (EOFError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            self.leave(player)
+            writer.close()
+
+
+class GameClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.messages = deque()
+        self.closed = False
+        self.task = asyncio.ensure_future(self.listen())
+
+    async def listen(self):
+        try:
+            while True:
+                self.messages.append(await read_message(self.reader))
+        except (EOFError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            self.closed = True
+
+    def send(self, message):
+        if not self.closed:
+            self.writer.write(encode(message))
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+        self.closed = True
+
+
+async def connect(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    return GameClient(reader, writer)
+
+
+async def serve(host, port, engine):
+    server = GameServer(engine)
+    listener = await asyncio.start_server(server.handle, host, port)
+    print(f"serving on {', '.join(str(sock.getsockname()) for sock in listener.sockets)}")
+    async with listener:
+        await listener.serve_forever()
+
+
+def _run_server(engine_name, ready, stop, stats):
+    async def run():
+        server = GameServer(load_engine(engine_name))
+        listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+        ready.put(listener.sockets[0].getsockname()[1])
+        while not stop.is_set():
+            await asyncio.sleep(0.05)
+        listener.close()
+        stats.put((time.process_time(), server.finished, server.moves))
+
+    asyncio.run(run())
+
+
+async def _bench_player(port, engine, rng, max_plies, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(encode(Join(3600)))
+    position = color = sent = None
+    while True:
+        message = await read_message(reader)
+        if isinstance(message, Ended):
+            break
+        if isinstance(message, Started):
+            position, color = Position(), 'w' if message.color == 0 else 'b'
+        elif isinstance(message, Moved):
+            if position.turn == color:
+                latencies.append(time.perf_counter() - sent)
+            position.make_move(message.move)
+        else:
+            continue
+        if position.turn == color:
+            moves = engine.get_all_legal_moves(position, color)
+            if len(position.stack) >= max_plies:
+                writer.write(encode(Resign()))
+            elif moves:
+                sent = time.perf_counter()
+                writer.write(encode(PlayMove(rng.choice(moves))))
+    writer.close()
+
+
+def _bench_worker(task):
+    port, engine_name, games, max_plies, seed = task
+    engine = load_engine(engine_name)
+    rng = random.Random(seed)
+    latencies = []
+
+    async def run():
+        await asyncio.gather(*(_bench_player(port, engine, rng, max_plies, latencies) for _ in range(2 * games)))
+
+    asyncio.run(run())
+    return latencies
+
+
+def bench(engine_name, games, clients, max_plies, seed):
+    ready, stats, stop = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Event()
+    server = multiprocessing.Process(target=_run_server, args=(engine_name, ready, stop, stats))
+    server.start()
+    port = ready.get()
+    shares = [games // clients + (i < games % clients) for i in range(clients)]
+    tasks = [(port, engine_name, share, max_plies, seed + i) for i, share in enumerate(shares) if share]
+    started = time.perf_counter()
+    with multiprocessing.Pool(len(tasks)) as pool:
+        latencies = sorted(latency for worker in pool.map(_bench_worker, tasks) for latency in worker)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    cpu, finished, moves = stats.get()
+    server.join()
+    return elapsed, cpu, finished, moves, latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Host networked games, or load-test a local server.")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="bitboard")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_command = commands.add_parser("serve")
+    serve_command.add_argument("--host", default="0.0.0.0")
+    serve_command.add_argument("--port", type=int, default=8765)
+    bench_command = commands.add_parser("bench", help="play random games against a server in a child process")
+    bench_command.add_argument("--games", type=int, default=200, help="games played at the same time")
+    bench_command.add_argument("--clients", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    bench_command.add_argument("--plies", type=int, default=80)
+    bench_command.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        try:
+            asyncio.run(serve(args.host, args.port, load_engine(args.engine)))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    elapsed, cpu, finished, moves, latencies = bench(args.engine, args.games, args.clients, args.plies, args.seed)
+    p50 = latencies[len(latencies) // 2] if latencies else 0
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0
+    print(f"{finished} games, {moves} moves in {elapsed:.2f}s: {moves / elapsed:.0f} moves/s, "
+          f"server CPU {cpu:.2f}s, {finished / cpu:.1f} games per core-second")
+    print(f"move latency p50 {1000 * p50:.2f} ms  p99 {1000 * p99:.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
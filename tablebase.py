@@ -0,0 +1,415 @@
+import argparse
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import defaultdict, namedtuple
+
+from perft import move_name
+from rules import (PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, WHITE, BLACK, ENGINES, KNIGHT_TARGETS, KING_TARGETS,
+                   ROOK_RAYS, BISHOP_RAYS, QUEEN_RAYS, Position, from_fen, load_engine)
+
+MAGIC = b"CTB1"
+HEADER = struct.Struct("<4s8sBBHI")
+LETTERS = {KING: 'K', QUEEN: 'Q', ROOK: 'R', BISHOP: 'B', KNIGHT: 'N', PAWN: 'P'}
+KINDS = {letter: kind for kind, letter in LETTERS.items()}
+VALUES = {KING: 0, QUEEN: 9, ROOK: 5, BISHOP: 3, KNIGHT: 3, PAWN: 1}
+MAX_PIECES = 4
+# Neither side can force mate, so these endings are draws without a table.
+DRAWN = ("KK", "KBK", "KNK")
+
+DRAW, WIN, LOSS, INVALID = 0, 1, 2, 3
+ILLEGAL, MATED, STALEMATE, NORMAL = 0, 1, 2, 3
+TablebaseResult = namedtuple("TablebaseResult", "wdl dtm")
+
+EMPTY_BOARD = [['--'] * 8 for _ in range(8)]
+
+
+def split_signature(signature):
+    second = signature.index('K', 1)
+    return signature[:second], signature[second:]
+
+
+def _side_value(side):
+    return sum(VALUES[KINDS[letter]] for letter in side), len(side), side
+
+
+def canonical_signature(signature):
+    white, black = split_signature(signature.upper())
+    white = ''.join(sorted(white, key=lambda letter: -KINDS[letter]))
+    black = ''.join(sorted(black, key=lambda letter: -KINDS[letter]))
+    return white + black if _side_value(white) >= _side_value(black) else black + white
+
+
+def signature_codes(signature):
+    white, black = split_signature(signature)
+    return [WHITE | KINDS[letter] for letter in white] + [BLACK | KINDS[letter] for letter in black]
+
+
+def position_signature(position):
+    sides = {WHITE: [], BLACK: []}
+    for piece in position.squares:
+        if piece:
+            sides[piece & 8].append(piece & 7)
+    return tuple(''.join(LETTERS[kind] for kind in sorted(sides[color], reverse=True)) for color in (WHITE, BLACK))
+
+
+def dependencies(signature):
+    # Endings reachable by one capture or promotion, which must be solved first.
+    found = set()
+    white, black = split_signature(signature)
+    for side, other, flip in ((white, black, False), (black, white, True)):
+        for i, letter in enumerate(side):
+            if letter == 'K':
+                continue
+            reduced = [side[:i] + side[i + 1:]]
+            if letter == 'P':
+                reduced += [side[:i] + promoted + side[i + 1:] for promoted in "QRBN"]
+            for new in reduced:
+                found.add(canonical_signature(other + new if flip else new + other))
+    return sorted(found - set(DRAWN), key=len)
+
+
+def decode_index(index, count):
+    squares = []
+    for _ in range(count):
+        squares.append(index & 63)
+        index >>= 6
+    return index, squares[::-1]
+
+
+def encode_index(side, codes, squares):
+    # Identical pieces are stored in ascending square order, the order table_index reads them from a bitboard.
+    if len(set(codes)) != len(codes):
+        groups = [codes.index(code) for code in codes]
+        squares = [sq for _, sq in sorted(zip(groups, squares))]
+    index = side
+    for sq in squares:
+        index = index * 64 + sq
+    return index
+
+
+def _canonical(codes, squares):
+    return all(codes[i] != codes[i + 1] or squares[i] < squares[i + 1] for i in range(len(codes) - 1))
+
+
+def table_index(position, codes, flip):
+    index = int((position.turn == 'b') != flip)
+    previous, bits = None, 0
+    for code in codes:
+        if code != previous:
+            bits = position.bitboards[code ^ 8 if flip else code]
+            previous = code
+        low = bits & -bits
+        bits ^= low
+        sq = low.bit_length() - 1
+        index = index * 64 + (sq ^ 56 if flip else sq)
+    return index
+
+
+class TablebaseFile:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, signature, self.pieces, self.bits, self.max_dtm, self.entries = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a tablebase")
+        self.signature = signature.rstrip(b"\0").decode()
+        self.codes = signature_codes(self.signature)
+        self.mask = (1 << self.bits) - 1
+
+    def value(self, index):
+        offset = index * self.bits
+        start = HEADER.size + (offset >> 3)
+        entry = int.from_bytes(self.map[start:start + 4], "little") >> (offset & 7) & self.mask
+        return entry & 3, entry >> 2
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class Tablebase:
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+
+    def table(self, signature):
+        if signature not in self.files:
+            path = os.path.join(self.directory, signature + ".ctb")
+            self.files[signature] = TablebaseFile(path) if os.path.exists(path) else None
+        return self.files[signature]
+
+    def probe(self, position):
+        # Tables are built without castling or en-passant rights.
+        if position.occupancy[WHITE].bit_count() + position.occupancy[BLACK].bit_count() > MAX_PIECES or \
+                position.castling or position.ep_square is not None:
+            return None
+        white, black = position_signature(position)
+        if white + black in DRAWN or black + white in DRAWN:
+            return TablebaseResult(0, 0)
+        flip = False
+        table = self.table(white + black)
+        if table is None:
+            flip = True
+            table = self.table(black + white)
+            if table is None:
+                return None
+        wdl, dtm = table.value(table_index(position, table.codes, flip))
+        if wdl == INVALID:
+            return None
+        return TablebaseResult((0, 1, -1)[wdl], dtm)
+
+    def best_move(self, engine, position, legal_moves=None):
+        current = self.probe(position)
+        if current is None:
+            return None
+        best, best_key = None, None
+        for move in legal_moves if legal_moves is not None else engine.get_all_legal_moves(position, position.turn):
+            position.make_move(move)
+            child = self.probe(position)
+            position.unmake_move()
+            if child is None:
+                continue
+            # Win as fast as possible, lose as slowly as possible, otherwise keep the draw.
+            key = (child.wdl, child.dtm if child.wdl < 0 else -child.dtm)
+            if best_key is None or key < best_key:
+                best, best_key = move, key
+        return best
+
+    def close(self):
+        for table in self.files.values():
+            if table is not None:
+                table.close()
+        self.files.clear()
+
+
+_worker = {}
+
+
+def _init_worker(directory, engine_name):
+    _worker["tablebase"] = Tablebase(directory)
+    _worker["engine"] = load_engine(engine_name)
+
+
+def _build_position(codes, squares, turn):
+    position = Position(EMPTY_BOARD, turn)
+    for code, sq in zip(codes, squares):
+        position.put(sq, code)
+    return position
+
+
+def _analyse_chunk(task):
+    # For every legal position with moves: the count of moves that stay inside the table, the longest loss reachable
+    # by a capture or promotion, and a seed for the retrograde pass when the result is already decided.
+    signature, start, stop = task
+    engine, tablebase = _worker["engine"], _worker["tablebase"]
+    codes = signature_codes(signature)
+    states = bytearray(stop - start)
+    remaining = array('H', bytes(2 * (stop - start)))
+    longest = array('H', bytes(2 * (stop - start)))
+    seeds, levels = array('I'), array('H')
+    for index in range(start, stop):
+        side, squares = decode_index(index, len(codes))
+        if len(set(squares)) != len(squares) or not _canonical(codes, squares) or any(
+                code & 7 == PAWN and sq // 8 in (0, 7) for code, sq in zip(codes, squares)):
+            continue
+        position = _build_position(codes, squares, 'b' if side else 'w')
+        if engine.is_in_check(position, 'w' if side else 'b'):
+            continue
+        moves = engine.get_all_legal_moves(position, position.turn)
+        if not moves:
+            states[index - start] = MATED if engine.is_in_check(position, position.turn) else STALEMATE
+            continue
+        states[index - start] = NORMAL
+        # Moves that leave the table to a draw or a win block a loss, so they are counted but never resolved.
+        count, win, loss = 0, -1, -1
+        for move in moves:
+            position.make_move(move)
+            if position.stack[-1][2] or move >> 12:
+                result = tablebase.probe(position)
+                if result is None:
+                    raise RuntimeError(f"{signature} needs the {'/'.join(position_signature(position))} table")
+                if result.wdl < 0:
+                    win = result.dtm + 1 if win < 0 else min(win, result.dtm + 1)
+                elif result.wdl > 0:
+                    loss = max(loss, result.dtm)
+                    count -= 1
+            count += 1
+            position.unmake_move()
+        remaining[index - start] = count
+        longest[index - start] = max(loss, 0)
+        if win >= 0:
+            seeds.append(index * 2 + 1)
+            levels.append(win)
+        elif not count:
+            seeds.append(index * 2)
+            levels.append(loss + 1)
+    return start, states, remaining, longest, seeds, levels
+
+
+def _unmoves(codes, squares, mover):
+    # Positions one quiet move earlier: the mover's pieces step back to empty squares; no uncaptures or unpromotions.
+    occupied = set(squares)
+    for i, (code, sq) in enumerate(zip(codes, squares)):
+        if code & 8 != mover:
+            continue
+        kind = code & 7
+        if kind == PAWN:
+            step, row = (8 if mover == WHITE else -8), sq // 8
+            origins = []
+            if (row <= 5 if mover == WHITE else row >= 2) and sq + step not in occupied:
+                origins.append(sq + step)
+                if row == (4 if mover == WHITE else 3) and sq + 2 * step not in occupied:
+                    origins.append(sq + 2 * step)
+        elif kind == KNIGHT or kind == KING:
+            origins = [origin for origin in (KNIGHT_TARGETS if kind == KNIGHT else KING_TARGETS)[sq]
+                       if origin not in occupied]
+        else:
+            origins = []
+            for ray in (ROOK_RAYS if kind == ROOK else BISHOP_RAYS if kind == BISHOP else QUEEN_RAYS)[sq]:
+                for origin in ray:
+                    if origin in occupied:
+                        break
+                    origins.append(origin)
+        for origin in origins:
+            yield squares[:i] + [origin] + squares[i + 1:]
+
+
+def solve(signature, states, remaining, longest, seeds, levels):
+    # Retrograde pass: resolve positions in order of distance to mate. Predecessors are found by generating
+    # un-moves from each resolved position, so no edge lists are stored.
+    codes = signature_codes(signature)
+    size = len(states)
+    value = bytearray([INVALID]) * size
+    dtm = array('H', bytes(2 * size))
+    buckets = defaultdict(lambda: array('I'))
+    for index in range(size):
+        if states[index] == MATED:
+            buckets[0].append(index * 2)
+        elif states[index] != ILLEGAL:
+            value[index] = DRAW
+    for seed, level in zip(seeds, levels):
+        buckets[level].append(seed)
+    del seeds, levels
+
+    resolved = bytearray(size)
+    level = 0
+    while buckets:
+        for seed in buckets.pop(level, ()):
+            index, won = seed >> 1, seed & 1
+            if resolved[index]:
+                continue
+            resolved[index] = 1
+            value[index] = WIN if won else LOSS
+            dtm[index] = level
+            side, squares = decode_index(index, len(codes))
+            for parent_squares in _unmoves(codes, squares, WHITE if side else BLACK):
+                parent = encode_index(side ^ 1, codes, parent_squares)
+                if resolved[parent] or states[parent] != NORMAL:
+                    continue
+                if not won:
+                    buckets[level + 1].append(parent * 2 + 1)
+                else:
+                    remaining[parent] -= 1
+                    longest[parent] = max(longest[parent], level)
+                    if not remaining[parent]:
+                        buckets[longest[parent] + 1].append(parent * 2)
+        level += 1
+    return value, dtm
+
+
+def write_table(path, signature, value, dtm):
+    max_dtm = max(dtm) if dtm else 0
+    bits = 2 + max(1, max_dtm.bit_length())
+    data = bytearray((len(value) * bits + 7) // 8 + 4)
+    accumulator = filled = position = 0
+    for code, distance in zip(value, dtm):
+        accumulator |= (code | distance << 2) << filled
+        filled += bits
+        while filled >= 8:
+            data[position] = accumulator & 255
+            accumulator >>= 8
+            filled -= 8
+            position += 1
+    if filled:
+        data[position] = accumulator
+    with open(path + ".tmp", "wb") as out:
+        out.write(HEADER.pack(MAGIC, signature.encode(), len(signature), bits, max_dtm, len(value)))
+        out.write(data)
+    os.replace(path + ".tmp", path)
+    return bits, max_dtm
+
+
+def generate(signature, directory, engine_name="bitboard", workers=None, chunk=4096):
+    signature = canonical_signature(signature)
+    if len(signature) > MAX_PIECES:
+        raise ValueError(f"{signature} has more than {MAX_PIECES} pieces")
+    os.makedirs(directory, exist_ok=True)
+    size = 2 * 64 ** len(signature)
+    states = bytearray(size)
+    remaining = array('H', bytes(2 * size))
+    longest = array('H', bytes(2 * size))
+    seeds, levels = array('I'), array('H')
+    tasks = [(signature, start, min(start + chunk, size)) for start in range(0, size, chunk)]
+    with multiprocessing.Pool(workers or os.cpu_count() or 1, _init_worker, (directory, engine_name)) as pool:
+        for start, chunk_states, chunk_remaining, chunk_longest, chunk_seeds, chunk_levels in pool.imap_unordered(
+                _analyse_chunk, tasks):
+            stop = start + len(chunk_states)
+            states[start:stop] = chunk_states
+            remaining[start:stop] = chunk_remaining
+            longest[start:stop] = chunk_longest
+            seeds.extend(chunk_seeds)
+            levels.extend(chunk_levels)
+    value, dtm = solve(signature, states, remaining, longest, seeds, levels)
+    return write_table(os.path.join(directory, signature + ".ctb"), signature, value, dtm)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate or probe endgame tablebases by retrograde analysis.")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="bitboard")
+    parser.add_argument("--directory", default="tablebases")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("generate")
+    build.add_argument("signatures", nargs="*", default=["KQK", "KRK", "KPK"])
+    build.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    build.add_argument("--force", action="store_true", help="regenerate tables that already exist")
+    probe = commands.add_parser("probe")
+    probe.add_argument("--fen", required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        requested = [canonical_signature(signature) for signature in args.signatures]
+        pending = []
+        for signature in requested:
+            for needed in dependencies(signature) + [signature]:
+                if needed not in pending:
+                    pending.append(needed)
+        for signature in pending:
+            path = os.path.join(args.directory, signature + ".ctb")
+            if os.path.exists(path) and not args.force and signature not in requested:
+                continue
+            started = time.perf_counter()
+            bits, max_dtm = generate(signature, args.directory, args.engine, args.workers)
+            print(f"{signature}: {2 * 64 ** len(signature)} positions, {bits} bits each, longest mate {max_dtm} plies, "
+                  f"{time.perf_counter() - started:.1f}s -> {path}")
+        return 0
+
+    tablebase = Tablebase(args.directory)
+    position = from_fen(args.fen)
+    result = tablebase.probe(position)
+    if result is None:
+        print("not in tablebase")
+        return 1
+    print(f"{('draw', 'win', 'loss')[result.wdl]} dtm {result.dtm}")
+    move = tablebase.best_move(load_engine(args.engine), position)
+    if move is not None:
+        print(f"best {move_name(move)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())